@@ -1,5 +1,77 @@
 import numpy as np
 
+from . import score_table
+
+
+# site -> the attribute used as the score of that site
+score_attrs = {
+    'ANN': 'bayesian_score',
+    'MAL': 'score',
+    'BGM': 'bayesian_score',
+    'AniList': 'bayesian_score',
+    'Anikore': 'bayesian_score',
+}
+min_votes = 100
+
+
+class RunningStats(object):
+    """
+    Count, mean and sum of squared deviations (M2) of some scores, which can be
+    updated by adding or removing a batch of scores without seeing the others
+    (Welford / Chan et al.).
+    """
+
+    def __init__(self, count=0, mean=0.0, m2=0.0):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+
+    @classmethod
+    def of(cls, values):
+        values = np.asarray(values, dtype=float)
+        if len(values) == 0:
+            return cls()
+        mean = values.mean()
+        return cls(len(values), mean, float(np.dot(values - mean, values - mean)))
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / self.count) if self.count > 0 else np.nan
+
+    def merge(self, other):
+        """
+        Add the scores summarized by another RunningStats.
+        """
+
+        count = self.count + other.count
+        if other.count == 0:
+            return self
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        return self
+
+    def add(self, values):
+        return self.merge(RunningStats.of(values))
+
+    def remove(self, values):
+        """
+        Remove scores which were added before.
+        """
+
+        other = RunningStats.of(values)
+        count = self.count - other.count
+        if count <= 0:
+            self.count, self.mean, self.m2 = 0, 0.0, 0.0
+            return self
+        mean = (self.mean * self.count - other.mean * other.count) / count
+        delta = other.mean - mean
+        self.m2 = max(self.m2 - other.m2 - delta * delta * count * other.count / self.count, 0.0)
+        self.mean = mean
+        self.count = count
+        return self
+
 
 def norm(scores, mean=0, std=1):
     """
@@ -16,6 +88,99 @@ def norm(scores, mean=0, std=1):
     return _scores
 
 
+def rescale(scores, from_mean, from_std, to_mean, to_std):
+    """
+    Move scores from a mean and std to another, in place.
+
+    @param scores: np.array of float.
+    @return: np.array, the same array as scores.
+    """
+
+    scores -= from_mean
+    scores *= to_std / from_std if from_std > 0 else np.nan
+    scores += to_mean
+    return scores
+
+
+def valid_mask(scores, votes, min_votes=min_votes):
+    """
+    @return: bool np.array, scores which take part in the adjustment.
+    """
+
+    return ~np.isnan(scores) & (votes >= min_votes)
+
+
+def site_stats(scores, votes, min_votes=min_votes):
+    """
+    Statistics of each site, one pass over each column.
+
+    @param scores: dict, site -> np.array of float, NaN for missing scores.
+    @param votes: dict, site -> np.array of float, corresponding votes.
+    @param min_votes: int, scores with less votes are ignored.
+    @return: dict, site -> RunningStats.
+    """
+
+    return {site: RunningStats.of(scores[site][valid_mask(scores[site], votes[site], min_votes)])
+            for site in scores}
+
+
+def pooled_stats(stats):
+    """
+    Statistics of all sites together, merged from the statistics of each site.
+
+    @param stats: dict, site -> RunningStats.
+    @return: RunningStats.
+    """
+
+    pooled = RunningStats()
+    for site_stat in stats.values():
+        pooled.merge(site_stat)
+    return pooled
+
+
+def adjust_columns(scores, votes, min_votes=min_votes, stats=None):
+    """
+    Adjust scores from different sites, so each site has the mean and std of all sites.
+
+    @param scores: dict, site -> np.array of float, NaN for missing scores.
+    @param votes: dict, site -> np.array of float, corresponding votes.
+    @param min_votes: int, scores with less votes are not adjusted.
+    @param stats: dict, site -> RunningStats. If given (e.g. kept up to date after
+           an incremental update), scores are not scanned again to get statistics.
+    @return: dict, site -> np.array of adjusted scores, NaN if not adjusted.
+    """
+
+    if stats is None:
+        stats = site_stats(scores, votes, min_votes)
+    pooled = pooled_stats(stats)
+
+    adjusted = {}
+    for site, column in scores.items():
+        out = rescale(np.array(column, dtype=float), stats[site].mean, stats[site].std, pooled.mean, pooled.std)
+        out[~valid_mask(column, votes[site], min_votes)] = np.nan
+        adjusted[site] = out
+    return adjusted
+
+
+def adjust_table(table, min_votes=min_votes, stats=None):
+    """
+    Adjust scores from different sites, over a ScoreTable.
+
+    @param table: score_table.ScoreTable.
+    @param min_votes: int, scores with less votes are not adjusted.
+    @param stats: dict, site -> RunningStats, see adjust_columns.
+    @return: ScoreTable, with column "adjusted_score" of each site set.
+    """
+
+    scores = {site: table.get(site, attr) for site, attr in score_attrs.items()}
+    votes = {site: table.get(site, 'votes') for site in score_attrs}
+    adjusted = adjust_columns(scores, votes, min_votes, stats)
+    for site, column in adjusted.items():
+        mask = ~np.isnan(column)
+        table.set(site, 'adjusted_score', column[mask], mask)
+    return table
+
+
 def adjust_scores(all_data):
     """
     Adjust scores from different sites.
@@ -24,49 +189,8 @@ def adjust_scores(all_data):
     @return: dict, with "adjusted_score" in each item.
     """
 
-    min_votes = 100
-
-    mapping = {
-        'ANN': 'bayesian_score',
-        'MAL': 'score',
-        'BGM': 'bayesian_score',
-        'AniList': 'bayesian_score',
-        'Anikore': 'bayesian_score',
-    }
-
-    all_scores = {
-        'ANN': ([], []),
-        'MAL': ([], []),
-        'BGM': ([], []),
-        'AniList': ([], []),
-        'Anikore': ([], []),
-    }
-    
-    for uid, item in all_data.items():
-        for site, attr in mapping.items():
-            if site in item and item[site] is not None:
-                if attr in item[site] and item[site][attr] is not None:
-                    score = item[site][attr]
-                    if item[site]['votes'] >= min_votes:
-                        all_scores[site][0].append(score)
-                        all_scores[site][1].append(uid)
-
-    overall_scores = []
-    for site, data in all_scores.items():
-        scores, uids = data
-        overall_scores.extend(scores)
-
-    overall_mean = np.mean(overall_scores)
-    overall_std = np.std(overall_scores)
-    # print(overall_mean, overall_std)
-
-    for site, data in all_scores.items():
-        scores, uids = data
-        if len(scores) > 0:
-            adj_scores = norm(scores, overall_mean, overall_std)
-            for adj_score, uid in zip(adj_scores, uids):
-                all_data[uid][site]['adjusted_score'] = adj_score
-
+    table = adjust_table(score_table.from_data(all_data))
+    score_table.write_back(table, all_data)
     return all_data
 
 
@@ -1,34 +1,92 @@
 import numpy as np
 
 
-def calc_bayesian_score(ratings, min_votes=100):
+def bayesian_scores(ratings, min_votes=100, prior=None, prior_weight=None):
     """
-    Calculate score using Bayesian Estimation.
+    Calculate score using Bayesian Estimation, vectorized.
 
     @param ratings: list/np.array, shaped N x C, where N is number of samples, C is number of classes.
            For an example, if ratings can be 1-5, then [[10, 20, 30, 40, 50]] means for sample 0,
            10 people rated 1, 20 people rated 2, ..., 50 people rated 5.
     @param min_votes: int, means the min number of votes one sample must reach to get a bayesian score.
+    @param prior: float, the prior score. If None, use the average of all votes.
+    @param prior_weight: float, how many votes the prior is worth. If None, use min_votes.
+    @return: np.array of float, shaped N. if votes < min_votes, bayesian score will be NaN.
+    """
+
+    ratings = np.asarray(ratings, dtype=float)
+    if ratings.size == 0:
+        return np.full(len(ratings), np.nan)
+    score = np.arange(1, ratings.shape[1] + 1)
+    v_sum = ratings.sum(1)
+    s_sum = ratings @ score
+    return bayesian_scores_by_sum(s_sum, v_sum, min_votes, prior, prior_weight)
+
+
+def bayesian_scores_by_average(score, votes, min_votes=100, prior=None, prior_weight=None):
+    """
+    Calculate score using Bayesian Estimation, vectorized.
+
+    @param score: list/np.array, shaped N, average scores of samples.
+    @param votes: list/np.array, shaped N, corresponding votes.
+    @param min_votes: int, means the min number of votes one sample must reach to get a bayesian score.
+    @param prior: float, the prior score. If None, use the average of all votes.
+    @param prior_weight: float, how many votes the prior is worth. If None, use min_votes.
+    @return: np.array of float, shaped N. if votes < min_votes, bayesian score will be NaN.
+    """
+
+    score = np.asarray(score, dtype=float)
+    votes = np.asarray(votes, dtype=float)
+    return bayesian_scores_by_sum(score * votes, votes, min_votes, prior, prior_weight)
+
+
+def bayesian_scores_by_sum(s_sum, v_sum, min_votes=100, prior=None, prior_weight=None):
+    """
+    Calculate score using Bayesian Estimation, i.e. pull the average score of each sample towards the prior.
+
+    @param s_sum: np.array, shaped N, sum of scores of each sample.
+    @param v_sum: np.array, shaped N, votes of each sample.
+    @param min_votes: int, means the min number of votes one sample must reach to get a bayesian score.
+    @param prior: float, the prior score. If None, use the average of all votes.
+    @param prior_weight: float, how many votes the prior is worth. If None, use min_votes.
+    @return: np.array of float, shaped N. if votes < min_votes, bayesian score will be NaN.
+    """
+
+    s_sum = np.asarray(s_sum, dtype=float)
+    v_sum = np.asarray(v_sum, dtype=float)
+
+    if prior is None:
+        prior = s_sum.sum() / v_sum.sum() if v_sum.sum() > 0 else np.nan
+    if prior_weight is None:
+        prior_weight = min_votes
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bayesian = (s_sum + prior_weight * prior) / (v_sum + prior_weight)
+    bayesian[v_sum < min_votes] = np.nan
+    return bayesian
+
+
+def to_list(scores):
+    """
+    Convert an array of scores to a list, NaN becomes None.
+
+    @param scores: np.array of float.
+    @return: list of float (or None).
+    """
+
+    return [None if s != s else s for s in np.asarray(scores).tolist()]
+
+
+def calc_bayesian_score(ratings, min_votes=100):
+    """
+    Calculate score using Bayesian Estimation.
+
+    @param ratings: list/np.array, shaped N x C, see bayesian_scores.
+    @param min_votes: int, means the min number of votes one sample must reach to get a bayesian score.
     @return: list, shaped N, each item is a bayesian score of that sample. if votes < min_votes,
              bayesian score will be None.
     """
 
-    ratings = np.array(ratings)
-    N, C = ratings.shape
-    score = np.arange(1, C + 1)
-    v_sum = np.sum(ratings)
-    s_sum = np.sum(ratings * score)
-    overall_avg = s_sum / v_sum
-    
-    v_sum = np.sum(ratings, 1)
-    s_sum = np.sum(ratings * score, 1)
-    bayesian = []
-    for v, s in zip(v_sum, s_sum):
-        if v < min_votes:
-            bayesian.append(None)
-        else:
-            bayesian.append((s + min_votes * overall_avg) / (v + min_votes))
-    return bayesian
+    return to_list(bayesian_scores(ratings, min_votes))
 
 
 def calc_bayesian_score_by_average(ratings, min_votes=100):
@@ -42,19 +100,7 @@ def calc_bayesian_score_by_average(ratings, min_votes=100):
              bayesian score will be None.
     """
 
-    score = np.array(ratings[0])
-    votes = np.array(ratings[1])
-    v_sum = np.sum(votes)
-    s_sum = np.sum(score * votes)
-    overall_avg = s_sum / v_sum
-
-    bayesian = []
-    for v, s in zip(votes, score):
-        if v < min_votes:
-            bayesian.append(None)
-        else:
-            bayesian.append((s * v + min_votes * overall_avg) / (v + min_votes))
-    return bayesian
+    return to_list(bayesian_scores_by_average(ratings[0], ratings[1], min_votes))
 
 
 if __name__ == '__main__':
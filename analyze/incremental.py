@@ -0,0 +1,229 @@
+import numpy as np
+
+from . import adjust, bayesian, score_table
+
+
+"""
+Incremental scoring.
+
+Scoring from scratch walks every title to get the bayesian priors and the
+normalization statistics, even if only a few titles changed since the last
+run. IncrementalScorer keeps a ScoreTable and the sufficient statistics
+(score sums and vote sums per site for the priors, count/mean/M2 per site for
+the normalization). When some items change, their old values are taken out
+of the statistics and the new ones are put in, and only the changed rows are
+re-scored. All rows of a site are re-scored only when a prior or a
+normalization parameter of that site moves more than `tolerance`.
+"""
+
+# sites scored by bayesian estimation
+bayesian_sites = ('BGM', 'AniList', 'Anikore')
+# site -> multiplier of the average score, for sites scored by average score and votes
+average_scales = {'Anikore': 2}
+
+
+def bayesian_inputs(table, site, rows):
+    """
+    Score sums and votes of rows, which the bayesian scores of a site are calculated from.
+
+    @param table: score_table.ScoreTable.
+    @param site: string, one of bayesian_sites.
+    @param rows: np.array of row indices.
+    @return: tuple of np.array (score sums, votes, bool mask of rows to be scored).
+             Score sums and votes are 0 for rows not to be scored.
+    """
+
+    if site in table.dists:
+        ratings = table.dists[site][rows]
+        return ratings @ np.arange(1, ratings.shape[1] + 1), ratings.sum(1), table.has_dist[site][rows]
+    score = table.get(site, 'score')[rows] * average_scales[site]
+    votes = table.get(site, 'votes')[rows]
+    mask = ~np.isnan(score) & ~np.isnan(votes)
+    return np.where(mask, score * votes, 0), np.where(mask, votes, 0), mask
+
+
+class IncrementalScorer(object):
+
+    def __init__(self, bayesian_min_votes=10, adjust_min_votes=adjust.min_votes, min_count=4, tolerance=1e-3):
+        """
+        @param bayesian_min_votes: int, min votes to get a bayesian score.
+        @param adjust_min_votes: int, min votes to get an adjusted score.
+        @param min_count: int, min number of sites to get a final score.
+        @param tolerance: float, how far a prior or a normalization parameter may move
+               before all rows of the site are re-scored.
+        """
+
+        self.bayesian_min_votes = bayesian_min_votes
+        self.adjust_min_votes = adjust_min_votes
+        self.min_count = min_count
+        self.tolerance = tolerance
+        self.table = score_table.ScoreTable([])
+        # site -> [score sum, vote sum] of all rows
+        self.sums = {site: np.zeros(2) for site in bayesian_sites}
+        # site -> the prior used by current bayesian scores
+        self.priors = {site: np.nan for site in bayesian_sites}
+        # site -> RunningStats of the scores taking part in the normalization
+        self.stats = {site: adjust.RunningStats() for site in adjust.score_attrs}
+        # site -> (site mean, site std, pooled mean, pooled std) used by current adjusted scores
+        self.norms = {}
+        # final score of each row, NaN if not enough sites
+        self.scores = np.full(0, np.nan)
+
+    def _moved(self, new, old):
+        # NaN always counts as moved
+        return not abs(new - old) <= self.tolerance
+
+    def _inputs(self, rows):
+        """
+        Values of rows which the scores are calculated from, one column for each value.
+        """
+
+        columns = []
+        for site in bayesian_sites:
+            columns.extend(bayesian_inputs(self.table, site, rows))
+        for site, attr in adjust.score_attrs.items():
+            if site not in bayesian_sites:
+                columns.append(self.table.get(site, attr)[rows])
+            columns.append(self.table.get(site, 'votes')[rows])
+        return np.stack(columns, 1).astype(float)
+
+    def _scores(self, site, rows):
+        """
+        @return: tuple of np.array (scores of rows, bool mask of scores taking part in the normalization).
+        """
+
+        scores = self.table.get(site, adjust.score_attrs[site])[rows]
+        votes = self.table.get(site, 'votes')[rows]
+        return scores, adjust.valid_mask(scores, votes, self.adjust_min_votes)
+
+    def _valid_scores(self, site, rows):
+        scores, mask = self._scores(site, rows)
+        return scores[mask]
+
+    def update(self, items):
+        """
+        Add, update or remove some items, and re-score what's affected.
+
+        @param items: dict, uid -> item data, or None to remove the uid.
+        @return: int, number of items whose scores need to be re-calculated.
+        """
+
+        table = self.table
+        uids = list(items)
+        rows = table.rows(uids)
+        if len(self.scores) < len(table):
+            self.scores = np.concatenate([self.scores, np.full(len(table) - len(self.scores), np.nan)])
+
+        before = self._inputs(rows)
+        old_scores = {site: self._scores(site, rows) for site in adjust.score_attrs}
+        for i, uid in zip(rows.tolist(), uids):
+            score_table.fill_row(table, i, items[uid])
+        mask = table.has_dist['AniList'][rows]
+        table.get('AniList', 'votes')[rows] = np.nan
+        table.set('AniList', 'votes', table.dists['AniList'][rows[mask]].sum(1), rows[mask])
+        after = self._inputs(rows)
+        same = ((before == after) | (np.isnan(before) & np.isnan(after))).all(1)
+        changed = rows[~same]
+        if len(changed) == 0:
+            return 0
+
+        # clear what will be re-calculated for changed rows
+        for site, attrs in score_table.derived_attrs.items():
+            for attr in attrs:
+                if attr != 'votes':
+                    table.get(site, attr)[changed] = np.nan
+        for site in score_table.sites:
+            table.get(site, 'adjusted_score')[changed] = np.nan
+
+        # bayesian scores, all rows of a site are re-scored if its prior moved
+        all_rows = np.arange(len(table))
+        rescored = {}
+        for k, site in enumerate(bayesian_sites):
+            self.sums[site] += (after[~same, 3 * k:3 * k + 2] - before[~same, 3 * k:3 * k + 2]).sum(0)
+            s_sum, v_sum = self.sums[site]
+            prior = s_sum / v_sum if v_sum > 0 else np.nan
+            target = changed
+            if self._moved(prior, self.priors[site]):
+                self.priors[site] = prior
+                target = all_rows
+            s_sum, v_sum, mask = bayesian_inputs(table, site, target)
+            scores = bayesian.bayesian_scores_by_sum(s_sum[mask], v_sum[mask], self.bayesian_min_votes,
+                                                     prior=self.priors[site])
+            table.set(site, 'bayesian_score', scores, target[mask])
+            rescored[site] = target
+
+        # normalization statistics, by deltas unless all rows of the site were re-scored
+        for site in adjust.score_attrs:
+            if site in rescored and len(rescored[site]) == len(table):
+                self.stats[site] = adjust.RunningStats.of(self._valid_scores(site, all_rows))
+            else:
+                scores, mask = old_scores[site]
+                self.stats[site].remove(scores[~same][mask[~same]]).add(self._valid_scores(site, changed))
+        pooled = adjust.pooled_stats(self.stats)
+
+        # adjusted scores, all rows of a site are re-scored if its parameters moved
+        renorm_all = False
+        for site, attr in adjust.score_attrs.items():
+            target = rescored.get(site, changed)
+            norm = (self.stats[site].mean, self.stats[site].std, pooled.mean, pooled.std)
+            if site not in self.norms or any(self._moved(a, b) for a, b in zip(norm, self.norms[site])):
+                self.norms[site] = norm
+                target = all_rows
+            if len(target) == len(table):
+                renorm_all = True
+            scores = table.get(site, attr)[target]
+            mask = adjust.valid_mask(scores, table.get(site, 'votes')[target], self.adjust_min_votes)
+            table.set(site, 'adjusted_score', adjust.rescale(scores[mask], *self.norms[site]), target[mask])
+
+        # final scores
+        target = all_rows if renorm_all else changed
+        scores, mask = score_table.average(table, 'adjusted_score', self.min_count, target)
+        self.scores[target] = np.where(mask, scores, np.nan)
+        return len(changed)
+
+    def sync(self, all_data):
+        """
+        Update the scorer to all_data, uids not in all_data are removed.
+
+        @param all_data: dict, uid -> item data.
+        @return: int, number of items whose scores need to be re-calculated.
+        """
+
+        items = dict(all_data)
+        for uid in self.table.uids:
+            if uid not in items:
+                items[uid] = None
+        return self.update(items)
+
+    def result(self, all_data):
+        """
+        Write the scores back to all_data.
+
+        @param all_data: dict, uid -> item data.
+        @return: list of items which get a final score, with "score" set.
+        """
+
+        score_table.write_back(self.table, all_data)
+        all_list = []
+        scores = self.scores.tolist()
+        for i in np.flatnonzero(~np.isnan(self.scores)).tolist():
+            item = all_data.get(self.table.uids[i])
+            if item is not None:
+                item['score'] = scores[i]
+                all_list.append(item)
+        return all_list
+
+
+if __name__ == '__main__':
+    """
+    Just for testing.
+    """
+
+    # import json
+    # with open('../all.json', 'r', encoding='utf-8') as f:
+    #     all_data = json.load(f)
+    # scorer = IncrementalScorer()
+    # print(scorer.sync(all_data), len(scorer.result(all_data)))
+    # uid = next(iter(all_data))
+    # all_data[uid]['MAL']['score'] += 0.1
+    # print(scorer.update({uid: all_data[uid]}))
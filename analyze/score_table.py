@@ -0,0 +1,233 @@
+import numpy as np
+
+
+"""
+Columnar score table for the analysis stage.
+
+all_data (uid -> site -> dict) is handy for fetching, but slow to walk again
+and again. ScoreTable reads it once into arrays: one row per uid, and for each
+site one float column per attribute (NaN if missing), plus the rating
+distribution if the site provides one. Scores are then calculated by array
+operations over the columns, and written back to all_data at the end.
+"""
+
+sites = ('ANN', 'MAL', 'BGM', 'AniList', 'Anikore')
+# numeric attributes read from the data of each site
+attrs = ('score', 'votes', 'bayesian_score')
+# attributes written back as int
+int_attrs = set(('votes',))
+# site -> attributes calculated in the analysis, not read from data
+derived_attrs = {
+    'BGM': ('bayesian_score',),
+    'AniList': ('bayesian_score', 'votes'),
+    'Anikore': ('bayesian_score',),
+}
+
+
+def read_bgm_dist(site_data):
+    rating_detail = site_data.get('rating_detail')
+    if rating_detail is None:
+        return None
+    dist = list(rating_detail.values())
+    dist.reverse()
+    return dist
+
+
+def read_anilist_dist(site_data):
+    stats = site_data['stats']['scoreDistribution']
+    if not stats:
+        return None
+    dist = [0 for _ in range(10)]
+    for stat in stats:
+        dist[int(stat['score'] / 10) - 1] = stat['amount']
+    return dist
+
+
+# site -> (number of classes, function to read the rating distribution from site data)
+dist_readers = {
+    'BGM': (10, read_bgm_dist),
+    'AniList': (10, read_anilist_dist),
+}
+
+
+class ScoreTable(object):
+
+    def __init__(self, uids):
+        """
+        @param uids: iterable of uid, one row for each.
+        """
+
+        self.uids = list(uids)
+        self.index = {uid: i for i, uid in enumerate(self.uids)}
+        size = len(self.uids)
+        # site -> bool array, whether the site has data of the row
+        self.present = {site: np.zeros(size, dtype=bool) for site in sites}
+        # site -> attr -> float array
+        self.columns = {site: {attr: np.full(size, np.nan) for attr in attrs} for site in sites}
+        # site -> N x C array, and bool array of rows which have a distribution
+        self.dists = {site: np.zeros((size, c)) for site, (c, _) in dist_readers.items()}
+        self.has_dist = {site: np.zeros(size, dtype=bool) for site in dist_readers}
+        # (site, attr) -> bool array, rows to write back
+        self.assigned = {}
+
+    def __len__(self):
+        return len(self.uids)
+
+    def append(self, uids):
+        """
+        Add empty rows for new uids.
+
+        @param uids: list of uid, not in the table yet.
+        """
+
+        for uid in uids:
+            self.index[uid] = len(self.uids)
+            self.uids.append(uid)
+
+        def grow(array, value):
+            extra = np.full((len(self) - len(array),) + array.shape[1:], value, dtype=array.dtype)
+            return np.concatenate([array, extra])
+
+        for site in sites:
+            self.present[site] = grow(self.present[site], False)
+            for attr, column in self.columns[site].items():
+                self.columns[site][attr] = grow(column, np.nan)
+        for site in self.dists:
+            self.dists[site] = grow(self.dists[site], 0)
+            self.has_dist[site] = grow(self.has_dist[site], False)
+        for key, mask in self.assigned.items():
+            self.assigned[key] = grow(mask, False)
+
+    def rows(self, uids):
+        """
+        Get row indices of uids, rows are added for new uids.
+
+        @param uids: list of uid.
+        @return: np.array of int.
+        """
+
+        new_uids = [uid for uid in dict.fromkeys(uids) if uid not in self.index]
+        if new_uids:
+            self.append(new_uids)
+        return np.array([self.index[uid] for uid in uids], dtype=int)
+
+    def get(self, site, attr):
+        """
+        @return: np.array of float, the column, NaN for missing values.
+        """
+
+        if attr not in self.columns[site]:
+            self.columns[site][attr] = np.full(len(self), np.nan)
+        return self.columns[site][attr]
+
+    def set(self, site, attr, values, mask=None):
+        """
+        Set values of a column. Rows set are written back by write_back.
+
+        @param site: string.
+        @param attr: string, e.g. 'bayesian_score'.
+        @param values: np.array, values of rows in mask.
+        @param mask: bool np.array or np.array of row indices, rows to set. If None, set all rows.
+        """
+
+        if mask is None:
+            mask = np.ones(len(self), dtype=bool)
+        self.get(site, attr)[mask] = values
+        if (site, attr) not in self.assigned:
+            self.assigned[(site, attr)] = np.zeros(len(self), dtype=bool)
+        self.assigned[(site, attr)][mask] = True
+
+
+def fill_row(table, i, item):
+    """
+    Read an item into a row of the table. Values read before are replaced,
+    derived attributes (see derived_attrs) are left as they are.
+
+    @param table: ScoreTable.
+    @param i: int, the row.
+    @param item: dict, item data, or None to clear the row.
+    """
+
+    for site in sites:
+        site_data = item.get(site) if item is not None else None
+        table.present[site][i] = site_data is not None
+        columns = table.columns[site]
+        for attr in attrs:
+            if attr in derived_attrs.get(site, ()):
+                continue
+            value = site_data.get(attr) if site_data is not None else None
+            columns[attr][i] = value if value is not None else np.nan
+        if site in dist_readers:
+            dist = dist_readers[site][1](site_data) if site_data is not None else None
+            table.has_dist[site][i] = dist is not None
+            table.dists[site][i] = dist if dist is not None else 0
+
+
+def from_data(all_data):
+    """
+    Build a ScoreTable from all_data, in one pass.
+
+    @param all_data: dict, uid -> item data, as in updater.py.
+    @return: ScoreTable.
+    """
+
+    table = ScoreTable(all_data.keys())
+    for i, item in enumerate(all_data.values()):
+        fill_row(table, i, item)
+    return table
+
+
+def write_back(table, all_data):
+    """
+    Write the columns set by ScoreTable.set back to all_data. NaN becomes None.
+
+    @param table: ScoreTable, built from all_data.
+    @param all_data: dict, uid -> item data. Rows not in it are skipped.
+    """
+
+    for (site, attr), mask in table.assigned.items():
+        values = table.columns[site][attr].tolist()
+        for i in np.flatnonzero(mask).tolist():
+            item = all_data.get(table.uids[i])
+            if item is None or item.get(site) is None:
+                continue
+            value = values[i]
+            if value != value:
+                value = None
+            elif attr in int_attrs:
+                value = int(value)
+            item[site][attr] = value
+
+
+def average(table, attr='adjusted_score', min_count=4, rows=None):
+    """
+    Average a column over all sites.
+
+    @param table: ScoreTable.
+    @param attr: string, the column to average.
+    @param min_count: int, min number of sites one row must have to get an average.
+    @param rows: np.array of row indices. If None, average all rows.
+    @return: tuple (np.array of float, bool np.array), the averages and rows having
+             at least min_count sites.
+    """
+
+    if rows is None:
+        rows = slice(None)
+    values = np.stack([table.get(site, attr)[rows] for site in sites], 1)
+    valid = ~np.isnan(values)
+    count = valid.sum(1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        avg = np.where(valid, values, 0).sum(1) / count
+    return avg, count >= min_count
+
+
+if __name__ == '__main__':
+    """
+    Just for testing.
+    """
+
+    # import json
+    # with open('../all.json', 'r', encoding='utf-8') as f:
+    #     all_data = json.load(f)
+    # table = from_data(all_data)
+    # print(len(table), {site: int(table.present[site].sum()) for site in sites})
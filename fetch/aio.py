@@ -0,0 +1,131 @@
+import asyncio
+import aiohttp
+import json
+
+from . import ratelimit, session
+
+
+"""
+Asyncio version of the shared session and rate limiter.
+
+Requests share the token buckets in ratelimit.py with the blocking fetchers,
+so per-site budgets and backoff are respected however many requests are in
+flight. The connector keeps connections alive and limits connections per host.
+
+A request reserves its time slot in the bucket when it starts waiting, and a
+slot can't be taken back. So only a few requests of a host may wait for (or
+hold) a slot at once, the others wait on a semaphore without reserving,
+otherwise every request would get its slot up front and a backoff could only
+slow down requests after all of them.
+"""
+
+# max connections in total, and for each host
+limit = 256
+limit_per_host = 8
+# max requests of a host holding a reserved slot at once
+max_reserved_per_host = limit_per_host
+
+
+class Response(object):
+    """
+    A fully-read response, with the attributes used by fetchers and ratelimit
+    (the same names as requests.Response).
+    """
+
+    def __init__(self, status_code, headers, content, encoding):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or 'utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.text)
+
+
+shared_session = None
+
+
+def get_session():
+    """
+    Get the shared aiohttp session, create it at the first call.
+    Must be called inside a running event loop.
+
+    @return: aiohttp.ClientSession.
+    """
+
+    global shared_session
+    if shared_session is None or shared_session.closed:
+        connect_timeout, read_timeout = session.timeout
+        shared_session = aiohttp.ClientSession(
+            headers=session.headers,
+            connector=aiohttp.TCPConnector(limit=limit, limit_per_host=limit_per_host),
+            timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout),
+        )
+    return shared_session
+
+
+semaphores = {}
+
+
+def get_semaphore(url):
+    """
+    Get the semaphore of a host, which caps its requests holding a reserved slot.
+    Must be called inside a running event loop.
+    """
+
+    host = ratelimit.get_host(url)
+    if host not in semaphores:
+        semaphores[host] = asyncio.Semaphore(max_reserved_per_host)
+    return semaphores[host]
+
+
+async def close_session():
+    global shared_session
+    if shared_session is not None:
+        await shared_session.close()
+        shared_session = None
+    # semaphores are bound to the event loop, the next run gets new ones
+    semaphores.clear()
+
+
+async def acquire(url):
+    bucket = ratelimit.get_bucket(url)
+    while True:
+        await asyncio.sleep(bucket.reserve())
+        # the bucket may get paused while we are waiting
+        if not bucket.paused():
+            return
+
+
+async def request(method, url, max_retries=3, **kwargs):
+    """
+    Send a request under rate limit, retry if throttled.
+
+    @param method: string, such as 'GET' or 'POST'.
+    @param url: string, the requested url.
+    @param max_retries: int, max times to retry when throttled.
+    @param kwargs: passed to aiohttp.ClientSession.request.
+    @return: Response, the last response even if still throttled.
+    """
+
+    for _ in range(max_retries + 1):
+        async with get_semaphore(url):
+            await acquire(url)
+            async with get_session().request(method, url, **kwargs) as r:
+                content = await r.read()
+                resp = Response(r.status, r.headers, content, r.charset)
+        if not ratelimit.report(url, resp):
+            break
+    return resp
+
+
+async def get(url, **kwargs):
+    return await request('GET', url, **kwargs)
+
+
+async def post(url, **kwargs):
+    return await request('POST', url, **kwargs)
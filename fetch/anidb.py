@@ -1,9 +1,11 @@
-import requests
 import traceback
+import shutil
 import json
 import gzip
 import xml.dom.minidom
 
+from . import ratelimit, session, utils
+
 
 """
 Notice that using AniDB API requires a registered client.
@@ -15,6 +17,26 @@ clientver = 1  # change this to your own client version
 protover = 1  # change this to your own protocol version
 
 
+dumped_file_url = 'http://anidb.net/api/anime-titles.xml.gz'
+chunk_size = 1 << 16
+xml_lang = '{http://www.w3.org/XML/1998/namespace}lang'
+
+
+class TeeReader(object):
+    """
+    A file-like wrapper, copying everything read from src into dst.
+    """
+
+    def __init__(self, src, dst):
+        self.src = src
+        self.dst = dst
+
+    def read(self, size=-1):
+        data = self.src.read(size)
+        self.dst.write(data)
+        return data
+
+
 def download_all_anime_list(fpath='anime-titles.xml'):
     """
     Download a list of all anime, from AniDB.
@@ -28,33 +50,116 @@ def download_all_anime_list(fpath='anime-titles.xml'):
     """
 
     try:
-        dumped_file_url = 'http://anidb.net/api/anime-titles.xml.gz'
         gzpath = fpath + '.gz'
-        # downloading
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_6) \
-            AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0.1 Safari/605.1.15'
-        }
-        resp = requests.get(dumped_file_url, headers=headers)
-        with open(gzpath, 'wb') as f:
-            f.write(resp.content)
-        # unzipping
-        gfile = gzip.GzipFile(gzpath)
-        with open(fpath, 'wb') as f:
-            f.write(gfile.read())
-        gfile.close()
+        # downloading, chunk by chunk
+        with session.get_session().get(dumped_file_url, stream=True) as resp:
+            with open(gzpath, 'wb') as f:
+                for chunk in resp.iter_content(chunk_size):
+                    f.write(chunk)
+        # unzipping, chunk by chunk
+        with gzip.open(gzpath, 'rb') as gfile:
+            with open(fpath, 'wb') as f:
+                shutil.copyfileobj(gfile, f, chunk_size)
         return True
     except Exception:
         traceback.print_exc()
         return False
 
 
+def open_dump(fpath):
+    """
+    Open a local-dumped file, decompressing on the fly if it ends with ".gz".
+
+    @param fpath: a string, the path of the local-dump file.
+    @return: a binary file object.
+    """
+
+    if fpath.endswith('.gz'):
+        return gzip.open(fpath, 'rb')
+    return open(fpath, 'rb')
+
+
+def iter_anime_titles(source):
+    """
+    Parse a dump in a streaming way, yield each anime with its titles.
+
+    @param source: a file-like object of the (decompressed) XML.
+    @return: a generator of dicts, each dict is like
+             {'aid': '1', 'titles': [{'type': 'main', 'lang': 'x-jat', 'title': '...'}]}.
+    """
+
+    for item in utils.iter_elements(source, 'anime'):
+        titles = []
+        for title in item.iter('title'):
+            titles.append({
+                'type': title.get('type'),
+                'lang': title.get(xml_lang),
+                'title': title.text,
+            })
+        yield {'aid': item.get('aid'), 'titles': titles}
+
+
+def iter_all_anime(fpath='anime-titles.xml.gz'):
+    """
+    Get all anime with titles, from local-dumped file (".xml" or ".xml.gz").
+    The file is decompressed and parsed chunk by chunk.
+
+    @param fpath: a string, the path of the local-dump file.
+    @return: a generator of dicts, see iter_anime_titles.
+    """
+
+    with open_dump(fpath) as f:
+        for anime in iter_anime_titles(f):
+            yield anime
+
+
+def stream_all_anime(gzpath=None):
+    """
+    Download the dump and yield anime while chunks arrive: download -> gunzip -> parse.
+    Neither the compressed nor the decompressed dump is held in memory.
+
+    @param gzpath: a string, if given, the compressed dump is also saved here,
+           so you don't need to download it again today.
+    @return: a generator of dicts, see iter_anime_titles.
+
+    P.S. Remember not to request the file "MORE THAN ONCE PER DAY".
+    """
+
+    with session.get_session().get(dumped_file_url, stream=True) as resp:
+        resp.raw.decode_content = False
+        src = resp.raw
+        dst = open(gzpath, 'wb') if gzpath is not None else None
+        try:
+            if dst is not None:
+                src = TeeReader(src, dst)
+            with gzip.GzipFile(fileobj=src) as gfile:
+                for anime in iter_anime_titles(gfile):
+                    yield anime
+        finally:
+            if dst is not None:
+                dst.close()
+
+
+def iter_all_anime_id(fpath='anime-titles.xml'):
+    """
+    Get ids (also called "aid") of all anime, from local-dumped file (".xml" or ".xml.gz").
+    The file is parsed in a streaming way, so memory stays flat.
+
+    @param fpath: a string, the path of the local-dump file.
+    @return: a generator of strings, each string is an id.
+    """
+
+    with open_dump(fpath) as f:
+        for item in utils.iter_elements(f, 'anime'):
+            yield item.get('aid')
+
+
 def get_all_anime_id_list(fpath='anime-titles.xml'):
     """
     Get a id (also called "aid") list of all anime, from local-dumped file.
     If anything failed, return None. (A typical error: file not exist)
 
-    @param fpath: a string, the path of the local-dump file.
+    @param fpath: a string, the path of the local-dump file (".xml" or ".xml.gz").
     @return: a list of strings, each string is an id.
 
     P.S. Make sure the file exists. This function won't check it for you,
@@ -62,11 +167,7 @@ def get_all_anime_id_list(fpath='anime-titles.xml'):
     """
 
     try:
-        dom = xml.dom.minidom.parse(fpath)
-        root = dom.documentElement
-        items = root.getElementsByTagName('anime')
-        id_list = [item.getAttribute('aid') for item in items]
-        return id_list
+        return list(iter_all_anime_id(fpath))
     except Exception:
         traceback.print_exc()
         return None
@@ -88,11 +189,7 @@ def get_anime_detail(aid):
     try:
         api_url = 'http://api.anidb.net:9001/httpapi?request=anime&client=' + client \
             + '&clientver=' + str(clientver) + '&protover=' + str(protover) + '&aid=' + str(aid)
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_6) \
-            AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0.1 Safari/605.1.15'
-        }
-        resp = requests.get(api_url, headers=headers)
+        resp = ratelimit.get(api_url)
         # response in XML format, parsing needed
         dom = xml.dom.minidom.parseString(resp.text)
         root = dom.documentElement
@@ -130,6 +227,8 @@ if __name__ == '__main__':
 
     # download_all_anime_list()
     # id_list = get_all_anime_id_list()
+    # for anime in stream_all_anime('anime-titles.xml.gz'):
+    #     print(anime)
     # print(len(id_list))
     # detail = get_anime_detail(5101)
     # print(detail)
@@ -1,12 +1,132 @@
-import requests
 import traceback
-import time
-import json
-import os
+import functools
 import re
 
 from tqdm import tqdm
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+from . import ratelimit, aio, cache_store, parse_pool, utils
+
+
+# seconds a cached anime stays fresh, after that it will be revalidated
+cache_ttl = 86400 * 7
+# version of parse_data, bump it when parse_data changes so cached details are re-parsed
+parser_version = 1
+
+# nodes of an anime page which parse_data needs
+detail_classes = set(('l-animeDetailHeader', 'l-animeDetailHeader_pointAndButtonBlock_starBlock',
+                      'l-breadcrumb_flexRoot'))
+h1_pattern = re.compile(r'<h1\b[^>]*>(.*?)</h1>', re.S)
+strong_pattern = re.compile(r'<strong\b[^>]*>(.*?)</strong>', re.S)
+a_pattern = re.compile(r'<a\b[^>]*>(.*?)</a>', re.S)
+li_pattern = re.compile(r'<li\b[^>]*>')
+
+
+def extract_detail(html):
+    """
+    Fast path of parse_data, pick the few nodes we need with regex instead of
+    building the DOM of the whole page.
+
+    @param html: string, the HTML-format text.
+    @return: tuple (title, score, votes, year), or None if the layout is not recognized.
+    """
+
+    try:
+        pos = utils.find_class(html, 'section', 'l-animeDetailHeader')
+        if pos < 0:
+            return None
+        title = utils.strip_tags(h1_pattern.search(html, pos).group(1))
+        pos = utils.find_class(html, 'div', 'l-animeDetailHeader_pointAndButtonBlock_starBlock')
+        if pos < 0:
+            return None
+        end = utils.find_end(html, 'div', pos)
+        score = float(utils.strip_tags(strong_pattern.search(html, pos, end).group(1)))
+        votes = int(utils.strip_tags(a_pattern.search(html, pos, end).group(1)))
+        pos = utils.find_class(html, 'ul', 'l-breadcrumb_flexRoot')
+        if pos < 0:
+            return None
+        end = utils.find_end(html, 'ul', pos)
+        li_list = [m.end() for m in li_pattern.finditer(html, pos, end)]
+        year = int(utils.find_href(html, li_list[2], end).split('/')[-2])
+        return title, score, votes, year
+    except Exception:
+        return None
+
+
+def extract_detail_soup(html):
+    """
+    Slow but tolerant version of extract_detail, only the needed nodes are parsed by BeautifulSoup.
+    """
+
+    # the strainer gets the whole class attribute, e.g. 'l-animeDetailHeader foo'
+    strainer = SoupStrainer(class_=lambda c: c is not None and not detail_classes.isdisjoint(c.split()))
+    soup = BeautifulSoup(html, utils.html_parser, parse_only=strainer)
+    title = soup.select('section.l-animeDetailHeader')[0].select('h1')[0].text
+    rating = soup.select('div.l-animeDetailHeader_pointAndButtonBlock_starBlock')[0]
+    score = float(rating.select('strong')[0].text)
+    votes = int(rating.select('a')[0].text)
+    air = soup.select('ul.l-breadcrumb_flexRoot')[0].select('li')[2]
+    year = int(air.a.attrs['href'].split('/')[-2])
+    return title, score, votes, year
+
+
+def parse_data(html, ani_id):
+    """
+    Parse the HTML of an anime page to extract information.
+
+    @param html: string, the HTML-format text.
+    @param ani_id: string or int, the id of the anime.
+    @return: dict, containing extracted information.
+    """
+
+    data = {'id': ani_id}
+    title, score, votes, year = extract_detail(html) or extract_detail_soup(html)
+    title = title.strip().replace('\r\n', '')
+    data['title'] = title
+    match_obj = re.match(r'「(.*)（(TVアニメ動画|アニメ映画|OVA)）」', title)
+    if match_obj:
+        data['jp_name'] = match_obj.group(1)
+        data['type'] = match_obj.group(2)
+    data['score'] = score
+    data['votes'] = votes
+    data['year'] = year
+    return data
+
+
+def extract_list_ids(html):
+    """
+    Fast path to extract anime ids from a 50-on page.
+
+    @param html: string, the HTML-format text.
+    @return: a list of int, or None if the layout is not recognized.
+    """
+
+    try:
+        pos = utils.find_class(html, 'div', 'rec_list_title')
+        if pos < 0:
+            return None
+        end = utils.find_end(html, 'div', pos)
+        if end < 0:
+            return None
+        id_list = []
+        while True:
+            pos = utils.find_class(html, 'div', 'rlta', pos, end)
+            if pos < 0:
+                break
+            id_list.append(int(utils.find_href(html, pos, end).split('/')[-1]))
+        return id_list
+    except Exception:
+        return None
+
+
+def extract_list_ids_soup(html):
+    """
+    Slow but tolerant version of extract_list_ids.
+    """
+
+    strainer = SoupStrainer('div', class_='rec_list_title')
+    soup = BeautifulSoup(html, utils.html_parser, parse_only=strainer)
+    div_list = soup.select('div.rec_list_title')[0]
+    return [int(item.div.a.attrs['href'].split('/')[-1]) for item in div_list.select('div.rlta')]
 
 
 def get_all_anime_list():
@@ -17,31 +137,21 @@ def get_all_anime_list():
     @return: a list of strings, each string is an id.
 
     P.S. Anikore provides all anime list in a way called 50-on (50音). We'll parse all
-         related pages to extract id list. We'll delay 10 seconds for each request.
+         related pages to extract id list. Requests are rate-limited by ratelimit.
     """
 
     try:
-        delay = 10
         base_url = 'https://www.anikore.jp/50on'
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_6) \
-            AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0.1 Safari/605.1.15'
-        }
         id_list = []
         for i in range(1, 4):
             for j in tqdm(range(1, 47)):
                 url = base_url + '-' + str(i) + '-' + str(j) + '/'
-                resp = requests.get(url, headers=headers)
+                resp = ratelimit.get(url)
                 html = resp.text
-                soup = BeautifulSoup(html, 'html.parser')
-                div_list = soup.select('div.rec_list_title')[0]
-                if not div_list:
-                    continue
-                items = div_list.select('div.rlta')
-                for item in items:
-                    ani_id = int(item.div.a.attrs['href'].split('/')[-1])
-                    id_list.append(ani_id)
-                time.sleep(delay)
+                ids = extract_list_ids(html)
+                if ids is None:
+                    ids = extract_list_ids_soup(html)
+                id_list.extend(ids)
         return id_list
     except Exception:
         traceback.print_exc()
@@ -65,42 +175,52 @@ def get_anime_detail(ani_id, cache=False, cache_dir='.'):
 
     try:
         url = 'https://www.anikore.jp/anime/' + str(ani_id)
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_6) \
-            AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0.1 Safari/605.1.15'
-        }
-        cache_path = os.path.join(cache_dir, '{}.json'.format(ani_id))
-        if cache and os.path.exists(cache_path):
-            with open(cache_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-        else:
-            resp = requests.get(url, headers=headers)
-            # response in json format
-            html = resp.text
-            if not html:
-                # got empty data
-                # retry in 30s
-                time.sleep(30)
-                return get_anime_detail(ani_id, cache, cache_dir)
-            data = {'id': ani_id}
-            soup = BeautifulSoup(html, 'html.parser')
-            title = soup.select('section.l-animeDetailHeader')[0].select('h1')[0].text
-            title = title.strip().replace('\r\n', '')
-            data['title'] = title
-            match_obj = re.match(r'「(.*)（(TVアニメ動画|アニメ映画|OVA)）」', title)
-            if match_obj:
-                data['jp_name'] = match_obj.group(1)
-                data['type'] = match_obj.group(2)
-            rating = soup.select('div.l-animeDetailHeader_pointAndButtonBlock_starBlock')[0]
-            data['score'] = float(rating.select('strong')[0].text)
-            data['votes'] = int(rating.select('a')[0].text)
-            air = soup.select('ul.l-breadcrumb_flexRoot')[0].select('li')[2]
-            data['year'] = int(air.a.attrs['href'].split('/')[-2])
-            if cache:
-                # add to cache
-                with open(cache_path, 'w', encoding='utf-8') as f:
-                    json.dump(data, f, indent=2, ensure_ascii=False)
-        return data
+        # a partial (not a lambda) can be sent to parse_pool
+        parse = functools.partial(parse_data, ani_id=ani_id)
+        hit, detail, entry = cache_store.load_detail(cache_dir, ani_id, parser_version, parse) \
+            if cache else (False, None, None)
+        if hit:
+            return detail
+        resp = ratelimit.get(url, headers=cache_store.conditional_headers(entry))
+        if cache_store.not_modified(entry, resp):
+            return cache_store.renew_detail(cache_dir, ani_id, parser_version, entry, parse)
+        html = resp.text
+        if not html:
+            # got empty data, retry after the pause of ratelimit
+            return get_anime_detail(ani_id, cache, cache_dir)
+        if cache:
+            # add to cache, raw HTML is kept for re-parsing
+            return cache_store.save_detail(cache_dir, ani_id, parser_version, html, resp, cache_ttl, parse)
+        return parse_pool.run(parse, html)
+    except Exception:
+        print('anikore: {}'.format(ani_id))
+        traceback.print_exc()
+        return None
+
+
+async def async_get_anime_detail(ani_id, cache=False, cache_dir='.'):
+    """
+    Async version of get_anime_detail.
+    """
+
+    try:
+        url = 'https://www.anikore.jp/anime/' + str(ani_id)
+        parse = functools.partial(parse_data, ani_id=ani_id)
+        hit, detail, entry = await cache_store.async_load_detail(cache_dir, ani_id, parser_version, parse) \
+            if cache else (False, None, None)
+        if hit:
+            return detail
+        resp = await aio.get(url, headers=cache_store.conditional_headers(entry))
+        if cache_store.not_modified(entry, resp):
+            return await cache_store.async_renew_detail(cache_dir, ani_id, parser_version, entry, parse)
+        html = resp.text
+        if not html:
+            # got empty data, retry after the pause of ratelimit
+            return await async_get_anime_detail(ani_id, cache, cache_dir)
+        if cache:
+            # add to cache, raw HTML is kept for re-parsing
+            return await cache_store.async_save_detail(cache_dir, ani_id, parser_version, html, resp, cache_ttl, parse)
+        return await parse_pool.async_run(parse, html)
     except Exception:
         print('anikore: {}'.format(ani_id))
         traceback.print_exc()
@@ -113,6 +233,7 @@ if __name__ == '__main__':
     """
 
     # id_list = get_all_anime_list()
+    # import json
     # with open('anikore.json', 'w', encoding='utf-8') as f:
     #     json.dump(id_list, f, indent=2)
     # detail = get_anime_detail(4940)
@@ -1,7 +1,111 @@
-import requests
 import traceback
-import json
-import os
+
+from tqdm import tqdm
+from . import ratelimit, aio, cache_store
+
+
+api_url = 'https://graphql.anilist.co'
+# seconds a cached anime stays fresh, GraphQL (POST) responses can't be revalidated
+cache_ttl = 86400 * 3
+
+media_fields = '''
+    id
+    title {
+        romaji
+        english
+        native
+    }
+    coverImage {
+        large
+    }
+    averageScore
+    stats {
+        scoreDistribution {
+            score
+            amount
+        }
+    }
+'''
+
+detail_query = '''
+query ($id: Int) {
+    Media (id: $id, type: ANIME) {
+        %s
+    }
+}
+''' % media_fields
+
+list_query = '''
+query ($ids: [Int], $perPage: Int) {
+    Page (page: 1, perPage: $perPage) {
+        media (id_in: $ids, type: ANIME) {
+            %s
+        }
+    }
+}
+''' % media_fields
+
+
+def get_anime_detail_list(id_list, cache=False, cache_dir='.'):
+    """
+    Get details for anime in list, from AniList.
+    You can enable cache to make less requests.
+    If anything failed, return None.
+
+    @param id_list: a list of strings or ints, each one is an id.
+    @param cache: boolean, enable cache. Cached anime won't be requested again,
+           and fetched anime will be cached.
+    @param cache_dir: string, path to cache directory.
+    @return: a list of dicts, each dict is the same as get_anime_detail returns.
+             Anime not found on AniList are not included.
+
+    P.S. Requests will be batched, up to 50 titles per request (the max page
+         size of AniList). A progress bar will be printed to screen.
+    """
+
+    try:
+        max_batch = 50
+        detail_list = []
+        to_fetch = []
+        for anl_id in id_list:
+            entry = cache_store.load(cache_dir, anl_id) if cache else None
+            if cache_store.is_fresh(entry):
+                detail_list.append(entry['body'])
+            else:
+                to_fetch.append(int(anl_id))
+        list_len = len(to_fetch)
+        for l_end in tqdm(range(0, list_len, max_batch)):
+            r_end = min(l_end + max_batch, list_len)
+            variables = {
+                'ids': to_fetch[l_end: r_end],
+                'perPage': max_batch,
+            }
+            resp = ratelimit.post(api_url, json={ 'query': list_query, 'variables': variables })
+            try:
+                items = resp.json()['data']['Page']['media']
+            except Exception:
+                # if fail to parse, just skip it
+                continue
+            for data in items:
+                if cache:
+                    # add to cache
+                    cache_store.save(cache_dir, data['id'], data, ttl=cache_ttl)
+                detail_list.append(data)
+        return detail_list
+    except Exception:
+        traceback.print_exc()
+        return None
+
+
+def cache_anime_detail_list(id_list, dir_path='.'):
+    """
+    Cache details for anime in list, from AniList.
+
+    @param id_list: a list of strings or ints, each one is an id.
+    @param dir_path: string, path to the cache directory.
+    """
+
+    get_anime_detail_list(id_list, True, dir_path)
 
 
 def get_anime_detail(anl_id, cache=False, cache_dir='.'):
@@ -17,44 +121,42 @@ def get_anime_detail(anl_id, cache=False, cache_dir='.'):
     """
 
     try:
-        api_url = 'https://graphql.anilist.co'
-        cache_path = os.path.join(cache_dir, '{}.json'.format(anl_id))
-        if cache and os.path.exists(cache_path):
-            with open(cache_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-        else:
-            query = '''
-            query ($id: Int) {
-                Media (id: $id, type: ANIME) {
-                    id
-                    title {
-                        romaji
-                        english
-                        native
-                    }
-                    coverImage {
-                        large
-                    }
-                    averageScore
-                    stats {
-                        scoreDistribution {
-                            score
-                            amount
-                        }
-                    }
-                }
-            }
-            '''
-            variables = {
-                'id': anl_id
-            }
-            resp = requests.post(api_url, json={ 'query': query, 'variables': variables })
-            data = resp.json()['data']
-            data = data['Media']
-            if cache:
-                # add to cache
-                with open(cache_path, 'w', encoding='utf-8') as f:
-                    json.dump(data, f, indent=2, ensure_ascii=False)
+        entry = cache_store.load(cache_dir, anl_id) if cache else None
+        if cache_store.is_fresh(entry):
+            return entry['body']
+        variables = {
+            'id': anl_id
+        }
+        resp = ratelimit.post(api_url, json={ 'query': detail_query, 'variables': variables })
+        data = resp.json()['data']
+        data = data['Media']
+        if cache:
+            # add to cache
+            cache_store.save(cache_dir, anl_id, data, resp, cache_ttl)
+        return data
+    except Exception:
+        traceback.print_exc()
+        return None
+
+
+async def async_get_anime_detail(anl_id, cache=False, cache_dir='.'):
+    """
+    Async version of get_anime_detail.
+    """
+
+    try:
+        entry = cache_store.load(cache_dir, anl_id) if cache else None
+        if cache_store.is_fresh(entry):
+            return entry['body']
+        variables = {
+            'id': anl_id
+        }
+        resp = await aio.post(api_url, json={ 'query': detail_query, 'variables': variables })
+        data = resp.json()['data']
+        data = data['Media']
+        if cache:
+            # add to cache
+            cache_store.save(cache_dir, anl_id, data, resp, cache_ttl)
         return data
     except Exception:
         traceback.print_exc()
@@ -67,3 +169,4 @@ if __name__ == '__main__':
     """
 
     # print(get_anime_detail(5114))
+    # print(get_anime_detail_list([5114, 9253]))
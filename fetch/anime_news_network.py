@@ -1,10 +1,14 @@
-import requests
-import xml.dom.minidom
 import traceback
-import time
-import os
 
+from xml.etree import ElementTree
 from tqdm import tqdm
+from . import ratelimit, aio, cache_store, parse_pool, utils
+
+
+# seconds a cached anime stays fresh, after that it will be revalidated
+cache_ttl = 86400 * 7
+# version of parse_data, bump it when parse_data changes so cached details are re-parsed
+parser_version = 1
 
 
 def parse_data(data):
@@ -12,37 +16,36 @@ def parse_data(data):
     Parse the data (response) to extract information.
     If anything failed, return None.
 
-    @param data: string/xml.dom.minidom.Element, string should be in XML format.
+    @param data: string/xml.etree.ElementTree.Element, string should be in XML format.
     @return: dict, containing extracted information.
     """
 
     try:
         if type(data) == str:
-            data = xml.dom.minidom.parseString(data)
-            data = data.documentElement
+            data = ElementTree.fromstring(data)
         
         detail = {}
-        detail['id'] = int(data.getAttribute('id'))
-        detail['type'] = data.getAttribute('type')
-        ratings = data.getElementsByTagName('ratings')
-        if not ratings:
+        detail['id'] = int(data.get('id'))
+        detail['type'] = data.get('type')
+        ratings = data.find('.//ratings')
+        if ratings is None:
             detail['votes'] = None
             detail['bayesian_score'] = None
             detail['weighted_score'] = None
         else:
-            ratings = ratings[0]
-            detail['votes'] = int(ratings.getAttribute('nb_votes'))
-            detail['bayesian_score'] = float(ratings.getAttribute('bayesian_score')) if ratings.hasAttribute('bayesian_score') else None
-            detail['weighted_score'] = float(ratings.getAttribute('weighted_score')) if ratings.hasAttribute('weighted_score') else None
-        infos = data.getElementsByTagName('info')
+            detail['votes'] = int(ratings.get('nb_votes'))
+            detail['bayesian_score'] = float(ratings.get('bayesian_score')) if ratings.get('bayesian_score') is not None else None
+            detail['weighted_score'] = float(ratings.get('weighted_score')) if ratings.get('weighted_score') is not None else None
         detail['titles'] = []
-        for info in infos:
-            info_type = info.getAttribute('type')
-            info_lang = info.getAttribute('lang')
+        for info in data.iter('info'):
+            info_type = info.get('type')
+            info_lang = info.get('lang')
+            if info.text is None:
+                continue
             if (info_type == 'Main title' or info_type == 'Alternative title') and (info_lang == 'EN' or info_lang == 'JA'):
-                detail['titles'].append(info.childNodes[0].data)
+                detail['titles'].append(info.text)
             elif info_type == 'Vintage':
-                vintage = info.childNodes[0].data
+                vintage = info.text
                 if '(' not in vintage:
                     detail['air'] = vintage
         return detail
@@ -51,6 +54,22 @@ def parse_data(data):
         return None
 
 
+def iter_all_anime_id():
+    """
+    Get ids of all anime, from Anime News Network.
+    The XML is parsed while downloading, ids are yielded as soon as they arrive.
+
+    @return: a generator of strings, each string is an id.
+    """
+
+    api_url = 'https://cdn.animenewsnetwork.com/encyclopedia/reports.xml?id=155&type=anime&nlist=all'
+    resp = ratelimit.get(api_url, stream=True)
+    resp.raw.decode_content = True
+    with resp:
+        for item in utils.iter_elements(resp.raw, 'item'):
+            yield item.findtext('id')
+
+
 def get_all_anime_id_list():
     """
     Get id list of all anime, from Anime News Network.
@@ -60,23 +79,28 @@ def get_all_anime_id_list():
     """
     
     try:
-        api_url = 'https://cdn.animenewsnetwork.com/encyclopedia/reports.xml?id=155&type=anime&nlist=all'
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_6) \
-            AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0.1 Safari/605.1.15'
-        }
-        resp = requests.get(api_url, headers=headers)
-        # response in XML format, parsing needed
-        dom = xml.dom.minidom.parseString(resp.text)
-        root = dom.documentElement
-        items = root.getElementsByTagName('item')
-        id_list = [item.getElementsByTagName('id')[0].childNodes[0].data for item in items]
-        return id_list
+        return list(iter_all_anime_id())
     except Exception:
         traceback.print_exc()
         return None
 
 
+def iter_anime(content):
+    """
+    Yield each <anime> element of a response of api.xml, parsed in a streaming way.
+    If the XML is broken, elements before the broken part are still yielded.
+
+    @param content: bytes, the response body.
+    @return: a generator of xml.etree.ElementTree.Element.
+    """
+
+    try:
+        for item in utils.iter_elements(content, 'anime'):
+            yield item
+    except ElementTree.ParseError:
+        return
+
+
 def get_anime_detail_list(id_list):
     """
     Get details for anime in list, from Anime News Network.
@@ -87,36 +111,23 @@ def get_anime_detail_list(id_list):
 
     P.S. Requests will be batched. However, it'll still take a long time
          since you can only batch up to 50 titles at once, and the API is
-         rate-limited to 1 request per second per IP address. A progress
-         bar will be printed to screen.
+         rate-limited to 1 request per second per IP address (handled by
+         ratelimit). A progress bar will be printed to screen.
     """
 
     try:
         api_url = 'https://cdn.animenewsnetwork.com/encyclopedia/api.xml?anime='
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_6) \
-            AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0.1 Safari/605.1.15'
-        }
         max_batch = 50
         list_len = len(id_list)
         detail_list = []
         for l_end in tqdm(range(0, list_len, max_batch)):
             r_end = min(l_end + max_batch, list_len)
             whole_url = api_url + '/'.join(id_list[l_end: r_end])
-            resp = requests.get(whole_url, headers=headers)
+            resp = ratelimit.get(whole_url)
             # response in XML format, parsing needed
-            try:
-                dom = xml.dom.minidom.parseString(resp.text)
-            except Exception:
-                # if fail to parse, just skip it
-                continue
-            root = dom.documentElement
-            items = root.getElementsByTagName('anime')
-            for item in items:
+            for item in iter_anime(resp.content):
                 detail = parse_data(item)
                 detail_list.append(detail) 
-            # api request rate limit
-            time.sleep(1)    
         return detail_list
     except Exception:
         traceback.print_exc()
@@ -132,41 +143,40 @@ def cache_anime_detail_list(id_list, dir_path='.'):
 
     P.S. Requests will be batched. However, it'll still take a long time
          since you can only batch up to 50 titles at once, and the API is
-         rate-limited to 1 request per second per IP address. A progress
-         bar will be printed to screen.
+         rate-limited to 1 request per second per IP address (handled by
+         ratelimit). A progress bar will be printed to screen.
     """
 
     try:
         api_url = 'https://cdn.animenewsnetwork.com/encyclopedia/api.xml?anime='
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_6) \
-            AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0.1 Safari/605.1.15'
-        }
         max_batch = 50
         list_len = len(id_list)
-        detail_list = []
         for l_end in tqdm(range(0, list_len, max_batch)):
             r_end = min(l_end + max_batch, list_len)
             whole_url = api_url + '/'.join(id_list[l_end: r_end])
-            resp = requests.get(whole_url, headers=headers)
-            try:
-                dom = xml.dom.minidom.parseString(resp.text)
-            except Exception:
-                # if fail to parse, just skip it
-                continue
-            root = dom.documentElement
-            items = root.getElementsByTagName('anime')
-            for item in items:
-                ann_id = item.getAttribute('id')
-                fpath = os.path.join(dir_path, '{}.xml'.format(ann_id))
-                with open(fpath, 'w', encoding='utf-8') as f:
-                    f.write(item.toprettyxml())
-            # api request rate limit
-            time.sleep(1)    
+            resp = ratelimit.get(whole_url)
+            for item in iter_anime(resp.content):
+                ann_id = item.get('id')
+                raw = ElementTree.tostring(item, encoding='unicode')
+                cache_store.save_detail(dir_path, ann_id, parser_version, raw, None, cache_ttl, parse_data)
     except Exception:
         traceback.print_exc()
 
 
+def extract_item(content):
+    """
+    Pick the anime out of a response of the detail API.
+
+    @param content: bytes, the XML response.
+    @return: string, XML of the anime element, or None if not found (e.g. a <warning> for no result).
+    """
+
+    item = next(iter_anime(content), None)
+    if item is None:
+        return None
+    return ElementTree.tostring(item, encoding='unicode')
+
+
 def get_anime_detail(ann_id, cache=False, cache_dir='.'):
     """
     Get detail for an anime, from Anime News Network.
@@ -181,26 +191,50 @@ def get_anime_detail(ann_id, cache=False, cache_dir='.'):
 
     try:
         api_url = 'https://cdn.animenewsnetwork.com/encyclopedia/api.xml?anime=' + str(ann_id)
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_6) \
-            AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0.1 Safari/605.1.15'
-        }
-        cache_path = os.path.join(cache_dir, '{}.xml'.format(ann_id))
-        if cache and os.path.exists(cache_path):
-            dom = xml.dom.minidom.parse(cache_path)
-            data = dom.documentElement
-        else:
-            resp = requests.get(api_url, headers=headers)
-            # response in xml format
-            dom = xml.dom.minidom.parseString(resp.text)
-            root = dom.documentElement
-            item = root.getElementsByTagName('anime')[0]
-            if cache:
-                # add to cache
-                with open(cache_path, 'w', encoding='utf-8') as f:
-                    f.write(item.toprettyxml())
-            data = item
-        return parse_data(data)
+        hit, detail, entry = cache_store.load_detail(cache_dir, ann_id, parser_version, parse_data) \
+            if cache else (False, None, None)
+        if hit:
+            return detail
+        resp = ratelimit.get(api_url, headers=cache_store.conditional_headers(entry))
+        if cache_store.not_modified(entry, resp):
+            return cache_store.renew_detail(cache_dir, ann_id, parser_version, entry, parse_data)
+        # response in xml format, picked and parsed in parse_pool
+        raw = parse_pool.run(extract_item, resp.content)
+        if raw is None:
+            print('ann: no result for {}'.format(ann_id))
+            return None
+        if cache:
+            # add to cache
+            return cache_store.save_detail(cache_dir, ann_id, parser_version, raw, resp, cache_ttl, parse_data)
+        return parse_pool.run(parse_data, raw)
+    except Exception:
+        traceback.print_exc()
+        return None
+
+
+async def async_get_anime_detail(ann_id, cache=False, cache_dir='.'):
+    """
+    Async version of get_anime_detail.
+    """
+
+    try:
+        api_url = 'https://cdn.animenewsnetwork.com/encyclopedia/api.xml?anime=' + str(ann_id)
+        hit, detail, entry = await cache_store.async_load_detail(cache_dir, ann_id, parser_version, parse_data) \
+            if cache else (False, None, None)
+        if hit:
+            return detail
+        resp = await aio.get(api_url, headers=cache_store.conditional_headers(entry))
+        if cache_store.not_modified(entry, resp):
+            return await cache_store.async_renew_detail(cache_dir, ann_id, parser_version, entry, parse_data)
+        # response in xml format, picked and parsed in parse_pool
+        raw = await parse_pool.async_run(extract_item, resp.content)
+        if raw is None:
+            print('ann: no result for {}'.format(ann_id))
+            return None
+        if cache:
+            # add to cache
+            return await cache_store.async_save_detail(cache_dir, ann_id, parser_version, raw, resp, cache_ttl, parse_data)
+        return await parse_pool.async_run(parse_data, raw)
     except Exception:
         traceback.print_exc()
         return None
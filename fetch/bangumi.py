@@ -1,13 +1,28 @@
-import requests
 import traceback
+import re
+import threading
 import time
-import json
-import os
+import functools
 import dateutil.parser
 
+from collections import OrderedDict
 from tqdm import tqdm
-from bs4 import BeautifulSoup
-from . import utils
+from bs4 import BeautifulSoup, SoupStrainer
+from . import utils, ratelimit, aio, cache_store
+
+
+# seconds a cached anime stays fresh, after that it will be revalidated
+cache_ttl = 86400 * 3
+# version of parse_data, bump it when parse_data changes so cached details are re-parsed
+parser_version = 1
+# details kept for tie-breaks of search_for_anime across searches with cache enabled,
+# 0 to disable. Keyed by (cache_dir, bgm_id), and dropped after cache_ttl like the cache
+detail_memo_size = 256
+detail_memo = OrderedDict()
+detail_memo_lock = threading.Lock()
+
+browser_list_pattern = re.compile(r'<ul\b[^>]*?\bid=["\']browserItemList["\'][^>]*>')
+li_pattern = re.compile(r'<li\b[^>]*>')
 
 
 def parse_data(data):
@@ -46,6 +61,46 @@ def parse_data(data):
         return None
 
 
+def extract_top_ids(html):
+    """
+    Fast path to extract anime ids from a page of the ranking list.
+
+    @param html: string, the HTML-format text.
+    @return: a list of strings, or None if the layout is not recognized.
+    """
+
+    match_obj = browser_list_pattern.search(html)
+    if match_obj is None:
+        return None
+    end = utils.find_end(html, 'ul', match_obj.end())
+    if end < 0:
+        return None
+    id_list = []
+    pos = match_obj.end()
+    while True:
+        match_obj = li_pattern.search(html, pos, end)
+        if match_obj is None:
+            break
+        # only the items directly under the list, skip nested ones
+        pos = utils.find_end(html, 'li', match_obj.end())
+        href = utils.find_href(html, match_obj.end(), pos)
+        if pos < 0 or href is None:
+            return None
+        id_list.append(href.split('/')[-1])
+    return id_list
+
+
+def extract_top_ids_soup(html):
+    """
+    Slow but tolerant version of extract_top_ids.
+    """
+
+    strainer = SoupStrainer('ul', id='browserItemList')
+    soup = BeautifulSoup(html, utils.html_parser, parse_only=strainer)
+    ul = soup.find_all('ul', id='browserItemList')[0]
+    return [item.a.attrs['href'].split('/')[-1] for item in ul.find_all('li', recursive=False)]
+
+
 def get_top_1000_id_list():
     """
     Get a list of top-1000 anime, from Bangumi.
@@ -60,25 +115,16 @@ def get_top_1000_id_list():
 
     try:
         prefix_url = 'https://bgm.tv/anime/browser?sort=rank&page='
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_6) \
-            AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0.1 Safari/605.1.15'
-        }
         id_list = []
         # items per page: 24
         for page in tqdm(range(1, 43)):
             web_url = prefix_url + str(page)
-            resp = requests.get(web_url, headers=headers)
+            resp = ratelimit.get(web_url)
             html = resp.text
-            # parse HTML-format text
-            soup = BeautifulSoup(html, 'html.parser')
-            ul = soup.find_all('ul', id='browserItemList')[0]
-            items = ul.contents
-            for item in items:
-                bgm_id = item.a.attrs['href'].split('/')[-1]
-                id_list.append(bgm_id)
-            # avoid making requests too fast
-            time.sleep(0.5)
+            ids = extract_top_ids(html)
+            if ids is None:
+                ids = extract_top_ids_soup(html)
+            id_list.extend(ids)
         # 42 pages * 24 items/page = 1008
         # however, we'll only keep top-1000
         id_list = id_list[:1000]
@@ -98,16 +144,10 @@ def cache_anime_detail(bgm_id, dir_path='.'):
 
     try:
         api_url = 'http://api.bgm.tv/subject/' + str(bgm_id) + '?responseGroup=large'
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_6) \
-            AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0.1 Safari/605.1.15'
-        }
-        resp = requests.get(api_url, headers=headers)
+        resp = ratelimit.get(api_url)
         # response in json format
         data = resp.json()
-        fpath = os.path.join(dir_path, '{}.json'.format(bgm_id))
-        with open(fpath, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        cache_store.save(dir_path, bgm_id, data, resp, cache_ttl)
     except Exception:
         traceback.print_exc()
 
@@ -130,22 +170,44 @@ def get_anime_detail(bgm_id, cache=False, cache_dir='.'):
     
     try:
         api_url = 'http://api.bgm.tv/subject/' + str(bgm_id) + '?responseGroup=large'
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_6) \
-            AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0.1 Safari/605.1.15'
-        }
-        cache_path = os.path.join(cache_dir, '{}.json'.format(bgm_id))
-        if cache and os.path.exists(cache_path):
-            with open(cache_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-        else:
-            resp = requests.get(api_url, headers=headers)
-            # response in json format
-            data = resp.json()
-            if cache:
-                # add to cache
-                with open(cache_path, 'w', encoding='utf-8') as f:
-                    json.dump(data, f, indent=2, ensure_ascii=False)
+        hit, detail, entry = cache_store.load_detail(cache_dir, bgm_id, parser_version, parse_data, False) \
+            if cache else (False, None, None)
+        if hit:
+            return detail
+        resp = ratelimit.get(api_url, headers=cache_store.conditional_headers(entry))
+        if cache_store.not_modified(entry, resp):
+            return cache_store.renew_detail(cache_dir, bgm_id, parser_version, entry, parse_data, False)
+        # response in json format
+        data = resp.json()
+        if cache:
+            # add to cache
+            return cache_store.save_detail(cache_dir, bgm_id, parser_version, data, resp, cache_ttl, parse_data, False)
+        return parse_data(data)
+    except Exception:
+        print('bgm_id: {}'.format(bgm_id))
+        traceback.print_exc()
+        return None
+
+
+async def async_get_anime_detail(bgm_id, cache=False, cache_dir='.'):
+    """
+    Async version of get_anime_detail.
+    """
+
+    try:
+        api_url = 'http://api.bgm.tv/subject/' + str(bgm_id) + '?responseGroup=large'
+        hit, detail, entry = cache_store.load_detail(cache_dir, bgm_id, parser_version, parse_data, False) \
+            if cache else (False, None, None)
+        if hit:
+            return detail
+        resp = await aio.get(api_url, headers=cache_store.conditional_headers(entry))
+        if cache_store.not_modified(entry, resp):
+            return cache_store.renew_detail(cache_dir, bgm_id, parser_version, entry, parse_data, False)
+        # response in json format
+        data = resp.json()
+        if cache:
+            # add to cache
+            return cache_store.save_detail(cache_dir, bgm_id, parser_version, data, resp, cache_ttl, parse_data, False)
         return parse_data(data)
     except Exception:
         print('bgm_id: {}'.format(bgm_id))
@@ -153,6 +215,111 @@ def get_anime_detail(bgm_id, cache=False, cache_dir='.'):
         return None
 
 
+@functools.lru_cache(maxsize=4096)
+def parse_date(date_str):
+    """
+    Parse a date string to a naive datetime, memoized since the same dates
+    are compared again and again when searching.
+    """
+
+    return dateutil.parser.parse(date_str).replace(tzinfo=None)
+
+
+def get_memo_detail(bgm_id, memo, cache, cache_dir):
+    """
+    get_anime_detail, memoized in the dict of one search, and if cache is
+    enabled, in a bounded LRU shared by all searches of the process (see
+    detail_memo_size). Without cache every search requests the details again.
+    Failed requests (None) are only memoized in the dict of the search.
+
+    @param memo: dict, bgm_id -> detail, owned by one search.
+    """
+
+    if bgm_id in memo:
+        return memo[bgm_id]
+    detail = None
+    shared = cache and detail_memo_size > 0
+    key = (cache_dir, bgm_id)
+    if shared:
+        with detail_memo_lock:
+            item = detail_memo.get(key)
+            if item is not None:
+                if time.time() - item[0] < cache_ttl:
+                    detail = item[1]
+                    detail_memo.move_to_end(key)
+                else:
+                    del detail_memo[key]
+    if detail is None:
+        detail = get_anime_detail(bgm_id, cache, cache_dir)
+        if detail is not None and shared:
+            with detail_memo_lock:
+                detail_memo[key] = (time.time(), detail)
+                while len(detail_memo) > detail_memo_size:
+                    detail_memo.popitem(last=False)
+    memo[bgm_id] = detail
+    return detail
+
+
+def air_delta(detail, air_date):
+    """
+    @return: int, days between air_date and the air date of an anime.
+    """
+
+    return abs((air_date - parse_date(detail['air_from'])).days)
+
+
+def search_subject(name, max_keep):
+    """
+    Search anime by a name, through the search api of Bangumi.
+
+    @return: list of search results, empty if anything failed.
+    """
+
+    api_url = 'http://api.bgm.tv/search/subject/' + name + '?type=2&max_results=' + str(max_keep)
+    resp = ratelimit.get(api_url)
+    # response in json format
+    try:
+        data = resp.json()['list']
+        if data is None:
+            data = []
+    except Exception:
+        # traceback.print_exc()
+        data = []
+    return data
+
+
+def pick_best_match(name, data, air_date, memo, cache, cache_dir, replace_unknown):
+    """
+    Pick the result whose name is the most similar to the given name.
+    Ties are broken by the air date closer to air_date.
+
+    @param replace_unknown: boolean, on a tie, whether to take the new result if
+           the air date of the current best one is unknown.
+    @return: int, bgm_id of the best result, or None.
+    """
+
+    best_match = None
+    best_match_lcs = 0
+    scores = utils.lcs_ratios(name, [item['name'].lower() for item in data])
+    for item, match_lcs in zip(data, scores):
+        bgm_id = item['id']
+        if match_lcs > best_match_lcs:
+            best_match_lcs = match_lcs
+            best_match = bgm_id
+        elif abs(match_lcs - best_match_lcs) < 1e-6:
+            detail_last = get_memo_detail(best_match, memo, cache, cache_dir) if best_match is not None else None
+            detail_curr = get_memo_detail(bgm_id, memo, cache, cache_dir)
+            if detail_last is None:
+                if replace_unknown:
+                    best_match = bgm_id
+                continue
+            elif detail_curr is None:
+                continue
+            if air_delta(detail_last, air_date) > air_delta(detail_curr, air_date):
+                best_match = bgm_id
+    return best_match
+
+
 def search_for_anime(jp_name, en_name, start_date, cache=False, cache_dir='.'):
     """
     Search a certain anime on MyAnimeList, through 3 main parameter.
@@ -173,115 +340,39 @@ def search_for_anime(jp_name, en_name, start_date, cache=False, cache_dir='.'):
 
     max_keep = 10
     try:
-        air_date = dateutil.parser.parse(start_date)
-        air_date = air_date.replace(tzinfo=None)
+        air_date = parse_date(start_date)
+        # details fetched in this search, shared by both passes
+        memo = {}
         # first, search by jp_name
+        best_match_jp = None
         if jp_name is not None:
             jp_name = jp_name.lower()
-            api_url = 'http://api.bgm.tv/search/subject/' + jp_name + '?type=2&max_results=' + str(max_keep)
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_6) \
-                AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0.1 Safari/605.1.15'
-            }
-            resp = requests.get(api_url, headers=headers)
-            # response in json format
-            try:
-                data = resp.json()['list']
-                if data is None:
-                    data = []
-            except Exception:
-                # traceback.print_exc()
-                data = []
-            best_match_jp = None
-            best_match_jp_lcs = 0
-            for item in data:
-                bgm_id = item['id']
-                tar_jp_name = item['name']
-                tar_jp_name = tar_jp_name.lower()
-                match_lcs = utils.lcs(jp_name, tar_jp_name) / min(len(jp_name), len(tar_jp_name))
-                if match_lcs > best_match_jp_lcs:
-                    best_match_jp_lcs = match_lcs
-                    best_match_jp = bgm_id
-                elif abs(match_lcs - best_match_jp_lcs) < 1e-6:
-                    detail_last = get_anime_detail(best_match_jp, cache, cache_dir) if best_match_jp is not None else None
-                    detail_curr = get_anime_detail(bgm_id, cache, cache_dir)
-                    if detail_last is None:
-                        best_match_jp = bgm_id
-                        continue
-                    elif detail_curr is None:
-                        continue
-                    air_date_last = dateutil.parser.parse(detail_last['air_from'])
-                    air_date_curr = dateutil.parser.parse(detail_curr['air_from'])
-                    air_date_last = air_date_last.replace(tzinfo=None)
-                    air_date_curr = air_date_curr.replace(tzinfo=None)
-                    delta_last = abs((air_date - air_date_last).days)
-                    delta_curr = abs((air_date - air_date_curr).days)
-                    best_match_jp = best_match_jp if delta_last <= delta_curr else bgm_id
+            data = search_subject(jp_name, max_keep)
+            best_match_jp = pick_best_match(jp_name, data, air_date, memo, cache, cache_dir, True)
             if best_match_jp is not None:
-                best_match_jp = get_anime_detail(best_match_jp, cache, cache_dir)
-        else:
-            best_match_jp = None
+                best_match_jp = get_memo_detail(best_match_jp, memo, cache, cache_dir)
         # then, search by en_name
+        best_match_en = None
         if en_name is not None:
             en_name = en_name.lower()
-            api_url = 'http://api.bgm.tv/search/subject/' + en_name + '?type=2&max_results=' + str(max_keep)
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_6) \
-                AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0.1 Safari/605.1.15'
-            }
-            resp = requests.get(api_url, headers=headers)
-            # response in json format
-            try:
-                data = resp.json()['list']
-                if data is None:
-                    data = []
-            except Exception:
-                # traceback.print_exc()
-                data = []
-            best_match_en = None
-            best_match_en_lcs = 0
-            for item in data:
-                bgm_id = item['id']
-                tar_jp_name = item['name']
-                tar_jp_name = tar_jp_name.lower()
-                match_lcs = utils.lcs(en_name, tar_jp_name) / min(len(en_name), len(tar_jp_name))
-                if match_lcs > best_match_en_lcs:
-                    best_match_en_lcs = match_lcs
-                    best_match_en = bgm_id
-                elif abs(match_lcs - best_match_en_lcs) < 1e-6:
-                    detail_last = get_anime_detail(best_match_en, cache, cache_dir) if best_match_en is not None else None
-                    detail_curr = get_anime_detail(bgm_id, cache, cache_dir)
-                    if detail_last is None or detail_curr is None:
-                        continue
-                    air_date_last = dateutil.parser.parse(detail_last['air_from'])
-                    air_date_curr = dateutil.parser.parse(detail_curr['air_from'])
-                    air_date_last = air_date_last.replace(tzinfo=None)
-                    air_date_curr = air_date_curr.replace(tzinfo=None)
-                    delta_last = abs((air_date - air_date_last).days)
-                    delta_curr = abs((air_date - air_date_curr).days)
-                    best_match_en = best_match_en if delta_last <= delta_curr else bgm_id
+            data = search_subject(en_name, max_keep)
+            best_match_en = pick_best_match(en_name, data, air_date, memo, cache, cache_dir, False)
             if best_match_en is not None:
-                best_match_en = get_anime_detail(best_match_en, cache, cache_dir)
-        else:
-            best_match_en = None
-        
+                best_match_en = get_memo_detail(best_match_en, memo, cache, cache_dir)
+
         if best_match_jp is None or best_match_en is None:
             if best_match_en is not None:
                 return best_match_en
             if best_match_jp is not None:
                 return best_match_jp
             return None
-        
+
         if best_match_jp['id'] == best_match_en['id']:
             return best_match_jp
         else:
             # compare 2 results, choose the best one
-            air_date_jp = dateutil.parser.parse(best_match_jp['air_from'])
-            air_date_en = dateutil.parser.parse(best_match_en['air_from'])
-            air_date_jp = air_date_jp.replace(tzinfo=None)
-            air_date_en = air_date_en.replace(tzinfo=None)
-            delta_jp = abs((air_date - air_date_jp).days)
-            delta_en = abs((air_date - air_date_en).days)
+            delta_jp = air_delta(best_match_jp, air_date)
+            delta_en = air_delta(best_match_en, air_date)
             return best_match_jp if delta_jp <= delta_en else best_match_en
     except Exception:
         traceback.print_exc()
@@ -0,0 +1,71 @@
+import argparse
+import time
+
+from . import anikore, bangumi, myanimelist
+
+
+"""
+Benchmark the fast (regex) HTML extractors against their BeautifulSoup versions.
+
+Save some pages first (e.g. curl https://www.anikore.jp/anime/1/ > 1.html), then run
+
+    python -m fetch.benchmark anikore_detail 1.html 2.html
+
+Outputs of both versions are compared, so it's also a quick check that the fast
+path still understands the current layout of the site.
+"""
+
+# name -> (fast extractor, BeautifulSoup extractor)
+extractors = {
+    'anikore_detail': (anikore.extract_detail, anikore.extract_detail_soup),
+    'anikore_list': (anikore.extract_list_ids, anikore.extract_list_ids_soup),
+    'bangumi_top': (bangumi.extract_top_ids, bangumi.extract_top_ids_soup),
+    'mal_links': (myanimelist.extract_external_links, myanimelist.extract_external_links_soup),
+}
+
+
+def timeit(func, pages, number):
+    """
+    @return: float, average seconds to extract one page.
+    """
+
+    start = time.perf_counter()
+    for _ in range(number):
+        for html in pages:
+            func(html)
+    return (time.perf_counter() - start) / (number * len(pages))
+
+
+def benchmark(name, pages, number=10):
+    """
+    Benchmark an extractor.
+
+    @param name: string, a key of extractors.
+    @param pages: a list of strings, HTML-format texts.
+    @param number: int, times to repeat.
+    @return: tuple (seconds per page of the fast version, of the BeautifulSoup version,
+             number of pages with different outputs).
+    """
+
+    fast, slow = extractors[name]
+    mismatch = 0
+    for html in pages:
+        if fast(html) != slow(html):
+            mismatch += 1
+    return timeit(fast, pages, number), timeit(slow, pages, number), mismatch
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark HTML extractors')
+    parser.add_argument('name', choices=sorted(extractors), help='Extractor to benchmark')
+    parser.add_argument('pages', nargs='+', help='Paths of saved HTML pages')
+    parser.add_argument('--number', type=int, default=10, help='Times to repeat')
+    args = parser.parse_args()
+
+    pages = []
+    for fpath in args.pages:
+        with open(fpath, encoding='utf-8') as f:
+            pages.append(f.read())
+    fast_time, slow_time, mismatch = benchmark(args.name, pages, args.number)
+    print('{}: regex {:.3f} ms/page, soup {:.3f} ms/page, {:.1f}x faster, {} mismatched'.format(
+        args.name, fast_time * 1000, slow_time * 1000, slow_time / fast_time, mismatch))
@@ -0,0 +1,510 @@
+import concurrent.futures
+import traceback
+import threading
+import sqlite3
+import shutil
+import json
+import time
+import zlib
+import os
+import re
+
+from . import parse_pool
+
+
+"""
+Shared cache layer for all fetchers.
+
+Each entry is keyed by (cache_dir, key), and contains:
+    body: the cached payload (JSON object, or string for XML).
+    fetched_at: timestamp when the payload was fetched (or revalidated).
+    ttl: seconds the entry stays fresh, None means never expire.
+    etag / last_modified: validators sent by the site, if any.
+
+A stale entry is not dropped. Fetchers send its validators in a conditional
+request, and if the site answers 304, the entry is renewed without downloading
+and parsing the whole body again.
+
+Entries are stored by a backend, decided by cache_dir:
+    "fetch/mal": one JSON file per entry, "fetch/mal/{key}.json".
+    "fetch/cache.sqlite/mal": rows of source "mal" in a single SQLite file
+        "fetch/cache.sqlite", with zlib-compressed payloads.
+If use_database(path) is called, every plain cache_dir is stored as a source
+in that SQLite file, so fetchers need no change to switch backends.
+"""
+
+
+class DirBackend(object):
+    """
+    One JSON file per entry.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, '{}.json'.format(key))
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def load(self, key):
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except ValueError:
+            return None
+
+    def write(self, key, entry):
+        # write atomically, so readers never see a half-written file
+        path = self.path(key)
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        try:
+            f = open(tmp_path, 'w', encoding='utf-8')
+        except FileNotFoundError:
+            # the directory may be removed by clear() of a parent directory
+            os.makedirs(self.cache_dir, exist_ok=True)
+            f = open(tmp_path, 'w', encoding='utf-8')
+        with f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def keys(self):
+        if not os.path.exists(self.cache_dir):
+            return []
+        return [name[:-len('.json')] for name in os.listdir(self.cache_dir) if name.endswith('.json')]
+
+    def clear(self):
+        # the parsed tier lives inside, so it's cleared too
+        if os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+        os.makedirs(self.cache_dir)
+
+
+class SqliteBackend(object):
+    """
+    All entries of a source in one table of a SQLite file, payloads compressed by zlib.
+    """
+
+    connections = {}
+    connections_lock = threading.Lock()
+
+    def __init__(self, db_path, source):
+        self.source = source
+        with SqliteBackend.connections_lock:
+            if db_path not in SqliteBackend.connections:
+                conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute('PRAGMA synchronous=NORMAL')
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS entries ('
+                    'source TEXT NOT NULL, key TEXT NOT NULL, fetched_at REAL, ttl REAL, '
+                    'etag TEXT, last_modified TEXT, body BLOB, PRIMARY KEY (source, key))'
+                )
+                SqliteBackend.connections[db_path] = (conn, threading.Lock())
+            self.conn, self.lock = SqliteBackend.connections[db_path]
+
+    def exists(self, key):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT 1 FROM entries WHERE source = ? AND key = ?', (self.source, str(key))
+            ).fetchone()
+        return row is not None
+
+    def load(self, key):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT fetched_at, ttl, etag, last_modified, body FROM entries WHERE source = ? AND key = ?',
+                (self.source, str(key))
+            ).fetchone()
+        if row is None:
+            return None
+        fetched_at, ttl, etag, last_modified, body = row
+        return {
+            'body': json.loads(zlib.decompress(body).decode('utf-8')),
+            'fetched_at': fetched_at,
+            'ttl': ttl,
+            'etag': etag,
+            'last_modified': last_modified,
+        }
+
+    def write(self, key, entry):
+        body = zlib.compress(json.dumps(entry['body'], ensure_ascii=False).encode('utf-8'))
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (self.source, str(key), entry['fetched_at'], entry['ttl'],
+                 entry['etag'], entry['last_modified'], body)
+            )
+
+    def keys(self):
+        with self.lock:
+            rows = self.conn.execute('SELECT key FROM entries WHERE source = ?', (self.source,)).fetchall()
+        return [row[0] for row in rows]
+
+    def clear(self):
+        # the parsed tier is a sub-source, so it's cleared too
+        with self.lock:
+            self.conn.execute(
+                'DELETE FROM entries WHERE source = ? OR source LIKE ?',
+                (self.source, self.source + os.sep + '%')
+            )
+
+
+database = None
+backends = {}
+backends_lock = threading.Lock()
+db_dir_pattern = re.compile(r'^(.+\.(?:sqlite|sqlite3|db))[/\\](.+)$')
+
+
+def use_database(db_path):
+    """
+    Store all plain cache_dirs in a SQLite file. Pass None to go back to directories.
+
+    @param db_path: string, path to the SQLite file.
+    """
+
+    global database
+    database = db_path
+
+
+def get_backend(cache_dir):
+    """
+    Get the backend of a cache_dir.
+
+    @param cache_dir: string, see the module docstring.
+    @return: DirBackend or SqliteBackend.
+    """
+
+    with backends_lock:
+        if (cache_dir, database) not in backends:
+            match_obj = db_dir_pattern.match(cache_dir)
+            if match_obj:
+                backend = SqliteBackend(match_obj.group(1), match_obj.group(2))
+            elif database is not None:
+                backend = SqliteBackend(database, cache_dir)
+            else:
+                backend = DirBackend(cache_dir)
+            backends[(cache_dir, database)] = backend
+        return backends[(cache_dir, database)]
+
+
+def exists(cache_dir, key):
+    return get_backend(cache_dir).exists(key)
+
+
+def load(cache_dir, key):
+    """
+    Load a cache entry.
+
+    @param cache_dir: string, path to cache directory.
+    @param key: string or int, usually an id.
+    @return: dict, the entry. None if not cached (or broken, or in the old raw format).
+    """
+
+    entry = get_backend(cache_dir).load(key)
+    if type(entry) != dict or 'body' not in entry or 'fetched_at' not in entry:
+        return None
+    return entry
+
+
+def write(cache_dir, key, entry):
+    get_backend(cache_dir).write(key, entry)
+
+
+def keys(cache_dir):
+    """
+    @return: list of strings, keys of all entries in a cache directory.
+    """
+
+    return get_backend(cache_dir).keys()
+
+
+def clear(cache_dir):
+    """
+    Remove all entries of a cache_dir.
+    """
+
+    get_backend(cache_dir).clear()
+
+
+def save(cache_dir, key, body, resp=None, ttl=None):
+    """
+    Save a payload to cache.
+
+    @param cache_dir: string, path to cache directory.
+    @param key: string or int, usually an id.
+    @param body: the payload, must be JSON-serializable.
+    @param resp: the response of the payload, used to record validators.
+    @param ttl: float, seconds the entry stays fresh. None means never expire.
+    @return: dict, the saved entry.
+    """
+
+    entry = {
+        'body': body,
+        'fetched_at': time.time(),
+        'ttl': ttl,
+        'etag': None,
+        'last_modified': None,
+    }
+    if resp is not None:
+        entry['etag'] = resp.headers.get('ETag')
+        entry['last_modified'] = resp.headers.get('Last-Modified')
+    write(cache_dir, key, entry)
+    return entry
+
+
+def is_fresh(entry, now=None):
+    if entry is None:
+        return False
+    if entry['ttl'] is None:
+        return True
+    if now is None:
+        now = time.time()
+    return now - entry['fetched_at'] < entry['ttl']
+
+
+def conditional_headers(entry):
+    """
+    Get headers for a conditional request, built from validators of a (stale) entry.
+
+    @param entry: dict, a cache entry or None.
+    @return: dict, headers.
+    """
+
+    headers = {}
+    if entry is not None:
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+
+def not_modified(entry, resp):
+    return entry is not None and resp.status_code == 304
+
+
+def renew(cache_dir, key, entry):
+    """
+    Mark an entry as just fetched, after the site answered 304.
+
+    @return: dict, the renewed entry.
+    """
+
+    entry['fetched_at'] = time.time()
+    write(cache_dir, key, entry)
+    return entry
+
+
+def set_ttl(cache_dir, key, ttl):
+    """
+    Change the ttl of an entry (and its parsed record), if the entry exists and the ttl differs.
+
+    @return: boolean, True if changed.
+    """
+
+    entry = load(cache_dir, key)
+    if entry is None or entry['ttl'] == ttl:
+        return False
+    entry['ttl'] = ttl
+    write(cache_dir, key, entry)
+    parsed = load(parsed_dir(cache_dir), key)
+    if parsed is not None:
+        parsed['ttl'] = ttl
+        write(parsed_dir(cache_dir), key, parsed)
+    return True
+
+
+"""
+The second tier: parsed records.
+
+Besides the raw payload (kept for debugging and re-parsing), the parsed detail
+is saved in "{cache_dir}/parsed", tagged by the parser version of the fetcher.
+A warm run reads the small parsed record only, and skips both the raw payload
+and the parsing. Bump the parser version of a fetcher when parse_data changes,
+then records of old versions are re-parsed from the raw payload.
+
+Raw payloads are parsed by parse_pool, in worker processes if the pool is
+started. The async_* versions await the pool instead of blocking the event loop.
+JSON sources pass offload=False: their parse_data only picks fields from a
+decoded dict, which costs less than pickling it to a worker and back.
+A payload which fails to parse is recorded with detail None, like parsers
+returning None, so it's not parsed again (and failing again) until it expires.
+"""
+
+
+def parsed_dir(cache_dir):
+    return os.path.join(cache_dir, 'parsed')
+
+
+def parse_payload(parse, body, offload=True):
+    """
+    Parse a raw payload by parse_pool.
+
+    @param offload: boolean, parse in the pool. If False, parse inline.
+    @return: the parsed detail, or None if parse raised.
+    """
+
+    try:
+        if offload:
+            return parse_pool.run(parse, body)
+        return parse_pool.call(parse, body)
+    except concurrent.futures.BrokenExecutor:
+        # not a problem of the payload
+        raise
+    except Exception:
+        traceback.print_exc()
+        return None
+
+
+async def async_parse_payload(parse, body):
+    """
+    Async version of parse_payload.
+    """
+
+    try:
+        return await parse_pool.async_run(parse, body)
+    except concurrent.futures.BrokenExecutor:
+        raise
+    except Exception:
+        traceback.print_exc()
+        return None
+
+
+def save_parsed(cache_dir, key, version, detail, entry):
+    """
+    Save a parsed detail, with the same fetch time and ttl as its raw entry.
+    """
+
+    parsed = {
+        'body': {'version': version, 'detail': detail},
+        'fetched_at': entry['fetched_at'],
+        'ttl': entry['ttl'],
+        'etag': None,
+        'last_modified': None,
+    }
+    write(parsed_dir(cache_dir), key, parsed)
+
+
+def load_detail(cache_dir, key, version, parse, offload=True):
+    """
+    Get a parsed detail from cache without any request.
+
+    @param cache_dir: string, path to cache directory.
+    @param key: string or int, usually an id.
+    @param version: int, parser version.
+    @param parse: a function, raw payload -> detail. Must be picklable, see parse_pool.
+    @param offload: boolean, parse in parse_pool. False for cheap parsers, e.g. of JSON sources.
+    @return: (hit, detail, entry). If hit is False, a request is needed, and
+             entry is the (stale) raw entry or None, used for a conditional request.
+    """
+
+    parsed = load(parsed_dir(cache_dir), key)
+    if is_fresh(parsed) and parsed['body']['version'] == version:
+        return True, parsed['body']['detail'], None
+    entry = load(cache_dir, key)
+    if is_fresh(entry):
+        detail = parse_payload(parse, entry['body'], offload)
+        save_parsed(cache_dir, key, version, detail, entry)
+        return True, detail, entry
+    return False, None, entry
+
+
+async def async_load_detail(cache_dir, key, version, parse):
+    """
+    Async version of load_detail.
+    """
+
+    parsed = load(parsed_dir(cache_dir), key)
+    if is_fresh(parsed) and parsed['body']['version'] == version:
+        return True, parsed['body']['detail'], None
+    entry = load(cache_dir, key)
+    if is_fresh(entry):
+        detail = await async_parse_payload(parse, entry['body'])
+        save_parsed(cache_dir, key, version, detail, entry)
+        return True, detail, entry
+    return False, None, entry
+
+
+def peek_detail(cache_dir, key, version, parse):
+    """
+    Get a parsed detail from cache, fresh or not, and never write anything.
+    For offline jobs which only need whatever was fetched before.
+
+    @return: the parsed detail, or None if not cached or failed to parse.
+    """
+
+    parsed = load(parsed_dir(cache_dir), key)
+    if parsed is not None and parsed['body']['version'] == version:
+        return parsed['body']['detail']
+    entry = load(cache_dir, key)
+    if entry is None:
+        return None
+    try:
+        return parse(entry['body'])
+    except Exception:
+        print('{}: failed to parse {}'.format(cache_dir, key))
+        traceback.print_exc()
+        return None
+
+
+def renew_detail(cache_dir, key, version, entry, parse, offload=True):
+    """
+    Renew a raw entry and its parsed record after the site answered 304.
+    The raw payload is re-parsed only if the parsed record is missing or outdated.
+
+    @return: the parsed detail.
+    """
+
+    entry = renew(cache_dir, key, entry)
+    parsed = load(parsed_dir(cache_dir), key)
+    if parsed is not None and parsed['body']['version'] == version:
+        detail = parsed['body']['detail']
+    else:
+        detail = parse_payload(parse, entry['body'], offload)
+    save_parsed(cache_dir, key, version, detail, entry)
+    return detail
+
+
+async def async_renew_detail(cache_dir, key, version, entry, parse):
+    """
+    Async version of renew_detail.
+    """
+
+    entry = renew(cache_dir, key, entry)
+    parsed = load(parsed_dir(cache_dir), key)
+    if parsed is not None and parsed['body']['version'] == version:
+        detail = parsed['body']['detail']
+    else:
+        detail = await async_parse_payload(parse, entry['body'])
+    save_parsed(cache_dir, key, version, detail, entry)
+    return detail
+
+
+def save_detail(cache_dir, key, version, body, resp, ttl, parse, offload=True):
+    """
+    Save a fetched raw payload and its parsed record.
+
+    @return: the parsed detail, None if the payload failed to parse.
+    """
+
+    entry = save(cache_dir, key, body, resp, ttl)
+    detail = parse_payload(parse, body, offload)
+    save_parsed(cache_dir, key, version, detail, entry)
+    return detail
+
+
+async def async_save_detail(cache_dir, key, version, body, resp, ttl, parse):
+    """
+    Async version of save_detail.
+    """
+
+    entry = save(cache_dir, key, body, resp, ttl)
+    detail = await async_parse_payload(parse, body)
+    save_parsed(cache_dir, key, version, detail, entry)
+    return detail
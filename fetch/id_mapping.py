@@ -1,7 +1,8 @@
-import requests
 import traceback
 import json
 
+from . import session
+
 
 def download_burstlink_mapping(fpath='burstlink.json'):
     """
@@ -17,11 +18,7 @@ def download_burstlink_mapping(fpath='burstlink.json'):
     try:
         url = 'https://raw.githubusercontent.com/soruly/burstlink/master/burstlink.json'
         # downloading
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_6) \
-            AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0.1 Safari/605.1.15'
-        }
-        resp = requests.get(url, headers=headers)
+        resp = session.get_session().get(url)
         mapping = resp.json()
         for i in range(len(mapping)):
             item = mapping[i]
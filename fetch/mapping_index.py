@@ -0,0 +1,268 @@
+import os
+import json
+import numpy as np
+
+
+"""
+Compact binary index of id.mapping.json.
+
+The JSON is a dict of dicts with string keys, slow to load and large in memory.
+MappingIndex keeps the same data in one int32 array shaped N x 6 (columns as
+in `sites`, null_id for null), saved as a .npy file which is memory-mapped
+when loaded. Any site id can be looked up by binary search on a sorted order
+of its column, or by a hash index (dict) of the column. Both are built at the
+first lookup. Besides, it supports bulk lookups and joins between sites,
+selecting anime by their sources, and dumping back to id.mapping.json.
+
+MappingIndex can also be used like the loaded JSON (mapping[uid], items(),
+len(), `in`), so code written for the dict keeps working.
+"""
+
+sites = ('mal', 'anidb', 'anilist', 'ann', 'bgm', 'anikore')
+null_id = -1
+json_path = 'id.mapping.json'
+index_path = 'id.mapping.npy'
+
+
+class MappingIndex(object):
+
+    def __init__(self, ids):
+        """
+        @param ids: np.array of int, shaped N x 6, columns as sites, null_id for null.
+               Column mal is never null, and uid is the mal id as string.
+        """
+
+        self.ids = ids
+        self._orders = {}
+        self._hashes = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def column(self, site):
+        return self.ids[:, sites.index(site)]
+
+    def _order(self, site):
+        """
+        Rows sorted by the ids of a site, nulls come first.
+        """
+
+        if site not in self._orders:
+            self._orders[site] = np.argsort(self.column(site), kind='stable')
+        return self._orders[site]
+
+    def _hash(self, site):
+        """
+        Site id -> the first row having it.
+        """
+
+        if site not in self._hashes:
+            index = {}
+            for row, site_id in enumerate(self.column(site).tolist()):
+                if site_id != null_id:
+                    index.setdefault(site_id, row)
+            self._hashes[site] = index
+        return self._hashes[site]
+
+    def find(self, site, site_id):
+        """
+        Find the row of a site id.
+
+        @param site: string, one of sites.
+        @param site_id: int.
+        @return: int, the row, or -1 if not found. If more than one rows have
+                 the id, the first one is returned.
+        """
+
+        return self._hash(site).get(site_id, -1)
+
+    def find_all(self, site, site_ids):
+        """
+        Find rows of many site ids at once, by binary search.
+
+        @param site: string, one of sites.
+        @param site_ids: list/np.array of int.
+        @return: np.array of int, the rows, -1 for ids not found.
+        """
+
+        site_ids = np.asarray(site_ids, dtype=np.int64)
+        if len(self) == 0:
+            return np.full(len(site_ids), -1)
+        column = self.column(site)
+        order = self._order(site)
+        pos = np.minimum(np.searchsorted(column, site_ids, sorter=order), len(order) - 1)
+        rows = order[pos]
+        found = (column[rows] == site_ids) & (site_ids != null_id)
+        return np.where(found, rows, -1)
+
+    def lookup(self, site, site_ids, target='mal'):
+        """
+        Translate ids of a site to ids of another site, e.g. lookup('bgm', bgm_ids, 'anilist').
+
+        @param site: string, site of the given ids.
+        @param site_ids: list/np.array of int.
+        @param target: string, site of the returned ids. Default to mal, i.e. uid.
+        @return: np.array of int, null_id if not found or null.
+        """
+
+        rows = self.find_all(site, site_ids)
+        return np.where(rows >= 0, self.column(target)[rows], null_id)
+
+    def uid_of(self, site, site_id):
+        """
+        @return: string, uid of a site id, or None if not found.
+        """
+
+        row = self.find(site, site_id)
+        return str(self.ids[row, 0]) if row >= 0 else None
+
+    def row(self, i):
+        """
+        @return: dict, the i-th anime, in the format of id.mapping.json.
+        """
+
+        return dict(zip(sites, [None if v == null_id else v for v in self.ids[i].tolist()]))
+
+    def __getitem__(self, uid):
+        row = self.find('mal', int(uid))
+        if row < 0:
+            raise KeyError(uid)
+        return self.row(row)
+
+    def get(self, uid, default=None):
+        return self[uid] if uid in self else default
+
+    def __contains__(self, uid):
+        try:
+            return self.find('mal', int(uid)) >= 0
+        except (TypeError, ValueError):
+            return False
+
+    def keys(self):
+        return [str(mal) for mal in self.column('mal').tolist()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def items(self):
+        for values in self.ids.tolist():
+            yield str(values[0]), dict(zip(sites, [None if v == null_id else v for v in values]))
+
+    def has(self, site):
+        """
+        @return: bool np.array, rows having an id of the site.
+        """
+
+        return self.column(site) != null_id
+
+    def source_count(self):
+        """
+        @return: np.array of int, number of sites having each anime.
+        """
+
+        return (self.ids != null_id).sum(1)
+
+    def where(self, min_sources=0, has=(), lacks=()):
+        """
+        Select anime by their sources.
+
+        @param min_sources: int, min number of sites (including mal).
+        @param has: tuple of sites, which the anime must have.
+        @param lacks: tuple of sites, which the anime must not have.
+        @return: bool np.array. Combine masks with & | ~ for other set operations.
+        """
+
+        mask = self.source_count() >= min_sources
+        for site in has:
+            mask &= self.has(site)
+        for site in lacks:
+            mask &= ~self.has(site)
+        return mask
+
+    def subset(self, mask):
+        """
+        @param mask: bool np.array or np.array of rows.
+        @return: MappingIndex, of the selected rows.
+        """
+
+        return MappingIndex(np.array(self.ids[mask]))
+
+    def to_dict(self):
+        """
+        @return: dict, in the format of id.mapping.json.
+        """
+
+        return dict(self.items())
+
+    def dump_json(self, fpath, indent=2):
+        """
+        Save in the format of id.mapping.json.
+
+        @param fpath: string, path of the json file.
+        @param indent: int, None for the most compact output.
+        """
+
+        with open(fpath, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, indent=indent, ensure_ascii=False)
+
+
+def from_dict(mapping):
+    """
+    Build a MappingIndex from the loaded id.mapping.json.
+
+    @param mapping: dict, uid -> {site: id or None}.
+    @return: MappingIndex.
+    """
+
+    ids = np.full((len(mapping), len(sites)), null_id, dtype=np.int32)
+    for i, (uid, item) in enumerate(mapping.items()):
+        if str(item['mal']) != str(uid):
+            raise ValueError('uid {} does not match its mal id {}'.format(uid, item['mal']))
+        for j, site in enumerate(sites):
+            if item.get(site) is not None:
+                ids[i, j] = item[site]
+    return MappingIndex(ids)
+
+
+def compile_mapping(src=json_path, dst=index_path):
+    """
+    Compile id.mapping.json to the binary index.
+
+    @param src: string, path of id.mapping.json.
+    @param dst: string, path of the index (.npy).
+    @return: MappingIndex.
+    """
+
+    with open(src, 'r', encoding='utf-8') as f:
+        index = from_dict(json.load(f))
+    tmp_path = dst + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, index.ids)
+    os.replace(tmp_path, dst)
+    return index
+
+
+def load(src=json_path, dst=index_path, mmap=True):
+    """
+    Load the binary index, (re-)compile it first if it's missing or older than id.mapping.json.
+
+    @param src: string, path of id.mapping.json.
+    @param dst: string, path of the index (.npy).
+    @param mmap: boolean, memory-map the index instead of reading it into memory.
+    @return: MappingIndex.
+    """
+
+    if not os.path.exists(dst) or (os.path.exists(src) and os.path.getmtime(src) > os.path.getmtime(dst)):
+        return compile_mapping(src, dst)
+    return MappingIndex(np.load(dst, mmap_mode='r' if mmap else None))
+
+
+if __name__ == '__main__':
+    """
+    Just for testing.
+    """
+
+    # index = load('../id.mapping.json', '../id.mapping.npy')
+    # print(len(index), index.uid_of('bgm', 253), index['1'])
+    # print(index.lookup('bgm', [253, 876], 'anilist'))
+    # index.subset(index.where(min_sources=4)).dump_json('../id.mapping.4.json')
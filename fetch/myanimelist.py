@@ -1,13 +1,11 @@
-import requests
 import traceback
-import time
-import json
-import os
+import re
 import dateutil.parser
 
+from html import unescape
 from tqdm import tqdm
-from bs4 import BeautifulSoup
-# from . import utils
+from bs4 import BeautifulSoup, SoupStrainer
+from . import ratelimit, aio, cache_store, utils
 
 
 """
@@ -25,17 +23,26 @@ jikan_api_pool = []
 jikan_api_idx = 0
 use_api_pool = False
 jikan_api = 'https://api.jikan.moe/v3'
-req_delay = 4
+# seconds a cached anime stays fresh, after that it will be revalidated
+cache_ttl = 86400 * 3
+# version of parse_data, bump it when parse_data changes so cached details are re-parsed
+parser_version = 1
+# the request rate is controlled by ratelimit, e.g. ratelimit.set_interval(jikan_api, 4)
+
+link_pattern = re.compile(r'<a\b[^>]*?\bhref=["\']([^"\']*)["\'][^>]*>(.*?)</a>', re.S)
 
 
 def change_api_url():
+    """
+    Switch to the next api in pool (if enabled), after being throttled.
+    The throttled api will be paused by ratelimit, so we don't sleep here.
+    """
+
     if use_api_pool:
-        global jikan_api_idx
+        global jikan_api, jikan_api_idx
         jikan_api_idx = (jikan_api_idx + 1) % len(jikan_api_pool)
         jikan_api = jikan_api_pool[jikan_api_idx]
         print('Now using Jikan api: ' + jikan_api)
-    print('Sleeping for 30s')
-    time.sleep(30)
 
 
 def parse_data(data):
@@ -89,12 +96,10 @@ def get_top_1000_id_list():
         anime_list = []
         for page in tqdm(range(1, 21)):
             whole_url = api_url + str(page)
-            resp = requests.get(whole_url)
+            resp = ratelimit.get(whole_url)
             # response in json format
             data = resp.json()['top']
             anime_list.extend([item['mal_id'] for item in data])
-            # api request rate-limit
-            time.sleep(req_delay)
         return anime_list
     except Exception:
         traceback.print_exc()
@@ -111,16 +116,14 @@ def cache_anime_detail(mal_id, dir_path='.'):
 
     try:
         api_url = jikan_api + '/anime/' + str(mal_id)
-        resp = requests.get(api_url)
+        resp = ratelimit.get(api_url)
         # response in json format
         data = resp.json()
         if 'error' in data and data['status'] == 403:
             # may get 403 for requesting too fast
             change_api_url()
-            cache_anime_detail(mal_id)
-        fpath = os.path.join(dir_path, '{}.json'.format(mal_id))
-        with open(fpath, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+            return cache_anime_detail(mal_id, dir_path)
+        cache_store.save(dir_path, mal_id, data, resp, cache_ttl)
     except Exception:
         traceback.print_exc()
 
@@ -139,23 +142,23 @@ def get_anime_detail(mal_id, cache=False, cache_dir='.'):
 
     try:
         api_url = jikan_api + '/anime/' + str(mal_id)
-        cache_path = os.path.join(cache_dir, '{}.json'.format(mal_id))
-        if cache and os.path.exists(cache_path):
-            with open(cache_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-        else:
-            resp = requests.get(api_url)
-            # response in json format
-            data = resp.json()
-            if 'error' in data:
-                if data['status'] == 403:
-                    # may get 403 for requesting too fast
-                    change_api_url()
-                    return get_anime_detail(mal_id, cache, cache_dir)
-            elif cache:
-                # add to cache
-                with open(cache_path, 'w', encoding='utf-8') as f:
-                    json.dump(data, f, indent=2, ensure_ascii=False)
+        hit, detail, entry = cache_store.load_detail(cache_dir, mal_id, parser_version, parse_data, False) \
+            if cache else (False, None, None)
+        if hit:
+            return detail
+        resp = ratelimit.get(api_url, headers=cache_store.conditional_headers(entry))
+        if cache_store.not_modified(entry, resp):
+            return cache_store.renew_detail(cache_dir, mal_id, parser_version, entry, parse_data, False)
+        # response in json format
+        data = resp.json()
+        if 'error' in data:
+            if data['status'] == 403:
+                # may get 403 for requesting too fast
+                change_api_url()
+                return get_anime_detail(mal_id, cache, cache_dir)
+        elif cache:
+            # add to cache
+            return cache_store.save_detail(cache_dir, mal_id, parser_version, data, resp, cache_ttl, parse_data, False)
         return parse_data(data)
     except Exception:
         print('mal_id: {}'.format(mal_id))
@@ -163,6 +166,66 @@ def get_anime_detail(mal_id, cache=False, cache_dir='.'):
         return None
 
 
+async def async_get_anime_detail(mal_id, cache=False, cache_dir='.'):
+    """
+    Async version of get_anime_detail.
+    """
+
+    try:
+        api_url = jikan_api + '/anime/' + str(mal_id)
+        hit, detail, entry = cache_store.load_detail(cache_dir, mal_id, parser_version, parse_data, False) \
+            if cache else (False, None, None)
+        if hit:
+            return detail
+        resp = await aio.get(api_url, headers=cache_store.conditional_headers(entry))
+        if cache_store.not_modified(entry, resp):
+            return cache_store.renew_detail(cache_dir, mal_id, parser_version, entry, parse_data, False)
+        # response in json format
+        data = resp.json()
+        if 'error' in data:
+            if data['status'] == 403:
+                # may get 403 for requesting too fast
+                change_api_url()
+                return await async_get_anime_detail(mal_id, cache, cache_dir)
+        elif cache:
+            # add to cache
+            return cache_store.save_detail(cache_dir, mal_id, parser_version, data, resp, cache_ttl, parse_data, False)
+        return parse_data(data)
+    except Exception:
+        print('mal_id: {}'.format(mal_id))
+        traceback.print_exc()
+        return None
+
+
+def extract_external_links(html):
+    """
+    Fast path to extract external links from an anime page.
+
+    @param html: string, the HTML-format text.
+    @return: a list of tuple (text, href), or None if the layout is not recognized.
+    """
+
+    pos = utils.find_class(html, 'div', 'pb16')
+    if pos < 0:
+        return None
+    end = utils.find_end(html, 'div', pos)
+    if end < 0:
+        return None
+    return [(utils.strip_tags(text), unescape(href))
+            for href, text in link_pattern.findall(html[pos:end])]
+
+
+def extract_external_links_soup(html):
+    """
+    Slow but tolerant version of extract_external_links.
+    """
+
+    strainer = SoupStrainer('div', class_='pb16')
+    soup = BeautifulSoup(html, utils.html_parser, parse_only=strainer)
+    div = soup.select('div.pb16')[0]
+    return [(item.text, item.attrs['href']) for item in div.select('a')]
+
+
 def get_external_links(mal_id, cookie):
     """
     Get external links for an anime, from MyAnimeList.
@@ -178,25 +241,18 @@ def get_external_links(mal_id, cookie):
 
     try:
         url = 'https://myanimelist.net/anime/' + str(mal_id)
+        # User-Agent is given by the shared session
         headers = {
-            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_6) \
-            AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0.1 Safari/605.1.15',
             'Cookie': cookie
         }
-        resp = requests.get(url, headers=headers)
+        resp = ratelimit.get(url, headers=headers)
         if resp.status_code == 403:
-            # may get 403 for requesting too fast
-            time.sleep(60)
-            # retry in 1 min
-            return get_external_links(mal_id)
+            # may get 403 for requesting too fast, retry after the pause of ratelimit
+            return get_external_links(mal_id, cookie)
         html = resp.text
-        # parse HTML-format text
-        soup = BeautifulSoup(html, 'html.parser')
-        div = soup.select('div.pb16')[0]
-        items = div.select('a')
-        result = []
-        for item in items:
-            result.append((item.text ,item.attrs['href']))
+        result = extract_external_links(html)
+        if result is None:
+            result = extract_external_links_soup(html)
         return result
     except Exception:
         traceback.print_exc()
@@ -0,0 +1,85 @@
+import asyncio
+import multiprocessing
+import concurrent.futures
+
+
+"""
+A process pool which parses fetched payloads off the fetching threads.
+
+Fetchers download the raw payload, then hand it with the parse function to
+the pool, so HTML/XML parsing runs on other cores, neither holding the GIL
+of the lane threads nor blocking the event loop of the async engine. The
+parse function must be picklable, i.e. defined at module level (use
+functools.partial instead of a lambda to bind arguments).
+
+The pool is off until start() is called, and then parsing runs inline as before.
+"""
+
+executor = None
+
+
+def start(workers=None):
+    """
+    Start the pool, do nothing if already started.
+
+    @param workers: int, number of worker processes. None for the number of cores.
+    @return: concurrent.futures.ProcessPoolExecutor.
+    """
+
+    global executor
+    if executor is None:
+        # workers are spawned lazily while fetching threads are running, forking them is not safe
+        executor = concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+    return executor
+
+
+def close():
+    global executor
+    if executor is not None:
+        executor.shutdown()
+        executor = None
+
+
+def call(func, *args):
+    """
+    Call func(*args), a StopIteration raised by func is raised as RuntimeError.
+    asyncio can't set a StopIteration to a future, so the coroutine awaiting it would never finish.
+    """
+
+    try:
+        return func(*args)
+    except StopIteration as e:
+        raise RuntimeError('{} raised StopIteration'.format(getattr(func, '__name__', func))) from e
+
+
+def run(func, *args):
+    """
+    Call func(*args) in the pool and wait for the result, or inline if the pool is off.
+    Exceptions raised by func are raised here.
+    """
+
+    if executor is None:
+        return call(func, *args)
+    return executor.submit(call, func, *args).result()
+
+
+async def async_run(func, *args):
+    """
+    Async version of run, the event loop keeps going while func runs in the pool.
+    """
+
+    if executor is None:
+        return call(func, *args)
+    return await asyncio.wrap_future(executor.submit(call, func, *args))
+
+
+if __name__ == '__main__':
+    """
+    Just for testing.
+    """
+
+    # from fetch import anikore
+    # start()
+    # with open('anikore.html', 'r', encoding='utf-8') as f:
+    #     print(run(anikore.parse_data, f.read(), 4940))
+    # close()
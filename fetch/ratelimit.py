@@ -0,0 +1,218 @@
+import threading
+import time
+
+from urllib.parse import urlsplit
+from . import session
+
+
+"""
+Shared rate limiter for all fetchers.
+
+Every host owns a token bucket. A request must take a token from the bucket of
+its host before being sent. When a site tells us to slow down (403, 429, or an
+empty body), the bucket halves its rate and pauses for a while (exponential
+backoff). Each successful response gives back a bit of the rate, until the
+configured budget is reached again.
+"""
+
+# requests per second for each host, a host not listed uses default_rate
+host_rates = {
+    'api.jikan.moe': 0.25,
+    'myanimelist.net': 0.25,
+    'api.bgm.tv': 2,
+    'bgm.tv': 2,
+    'graphql.anilist.co': 1,
+    'cdn.animenewsnetwork.com': 1,
+    'www.anikore.jp': 0.25,
+    'api.anidb.net': 0.5,
+}
+default_rate = 1
+burst = 1
+
+# backoff settings
+min_rate_ratio = 0.1  # the rate never drops below min_rate_ratio * budget
+recover_ratio = 0.05  # each success recovers recover_ratio * budget
+backoff_base = 5  # seconds to pause after the first failure, doubled after each failure
+backoff_max = 300
+throttled_status = set((403, 429))
+no_body_status = set((204, 304))
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, capacity=1):
+        """
+        @param rate: float, tokens (requests) per second.
+        @param capacity: int, max tokens can be saved, i.e. the burst size.
+        """
+
+        self.budget = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.paused_until = 0
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        if now > self.last:
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+
+    def reserve(self):
+        """
+        Take a token, maybe borrowed from the future.
+        Each caller gets its own time slot, so many waiters won't wake up together.
+
+        @return: float, seconds to wait before the token can be used.
+        """
+
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            return max(self.last - now, 0) + max(-self.tokens, 0) / self.rate
+
+    def paused(self):
+        return time.monotonic() < self.paused_until
+
+    def acquire(self):
+        """
+        Block until a token is available, then take it.
+        """
+
+        while True:
+            time.sleep(self.reserve())
+            # the bucket may get paused while we are waiting
+            if not self.paused():
+                return
+
+    def set_budget(self, rate):
+        with self.lock:
+            self.budget = rate
+            self.rate = rate
+
+    def penalize(self, pause=None):
+        """
+        Slow down after being throttled.
+
+        @param pause: float, seconds to pause. If None, use exponential backoff.
+        """
+
+        with self.lock:
+            self.failures += 1
+            if pause is None:
+                pause = min(backoff_base * 2 ** (self.failures - 1), backoff_max)
+            self.rate = max(self.rate / 2, self.budget * min_rate_ratio)
+            # keep the borrowed tokens, so reserved slots stay in order
+            self.tokens = min(self.tokens, 0)
+            self.paused_until = max(self.paused_until, time.monotonic() + pause)
+            self.last = self.paused_until
+
+    def reward(self):
+        """
+        Speed up (until the budget) after a successful request.
+        """
+
+        with self.lock:
+            self.failures = 0
+            self.rate = min(self.budget, self.rate + self.budget * recover_ratio)
+
+
+buckets = {}
+buckets_lock = threading.Lock()
+
+
+def get_host(url):
+    return urlsplit(url).hostname or url
+
+
+def get_bucket(url):
+    """
+    Get the token bucket of a host, create it if not exists.
+
+    @param url: string, a url or a host name.
+    @return: TokenBucket.
+    """
+
+    host = get_host(url)
+    with buckets_lock:
+        if host not in buckets:
+            buckets[host] = TokenBucket(host_rates.get(host, default_rate), burst)
+        return buckets[host]
+
+
+def set_interval(url, interval):
+    """
+    Set the budget of a host by min interval between 2 requests.
+
+    @param url: string, a url or a host name.
+    @param interval: float, seconds.
+    """
+
+    host = get_host(url)
+    rate = 1 / interval if interval > 0 else 1e6
+    host_rates[host] = rate
+    get_bucket(host).set_budget(rate)
+
+
+def acquire(url):
+    get_bucket(url).acquire()
+
+
+def penalize(url, pause=None):
+    get_bucket(url).penalize(pause)
+
+
+def report(url, resp, check_body=True):
+    """
+    Report a response to the limiter, so the limiter can adapt its rate.
+
+    @param url: string, the requested url.
+    @param resp: requests.Response.
+    @param check_body: boolean, treat an empty body as throttled.
+           Disable it for streamed responses, or the whole body will be read.
+    @return: boolean, True if we are throttled and should retry later.
+    """
+
+    bucket = get_bucket(url)
+    if check_body:
+        empty = not resp.content and resp.status_code not in no_body_status
+    else:
+        empty = resp.headers.get('Content-Length') == '0'
+    throttled = resp.status_code in throttled_status or empty
+    if throttled:
+        retry_after = resp.headers.get('Retry-After')
+        pause = float(retry_after) if retry_after and retry_after.isdigit() else None
+        bucket.penalize(pause)
+    else:
+        bucket.reward()
+    return throttled
+
+
+def request(method, url, max_retries=3, **kwargs):
+    """
+    Send a request under rate limit, retry if throttled.
+
+    @param method: string, such as 'GET' or 'POST'.
+    @param url: string, the requested url.
+    @param max_retries: int, max times to retry when throttled.
+    @param kwargs: passed to the request method of the shared session.
+    @return: requests.Response, the last response even if still throttled.
+    """
+
+    for _ in range(max_retries + 1):
+        acquire(url)
+        resp = session.get_session().request(method, url, **kwargs)
+        if not report(url, resp, not kwargs.get('stream')):
+            break
+    return resp
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
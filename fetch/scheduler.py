@@ -0,0 +1,86 @@
+import threading
+import traceback
+import queue
+
+
+"""
+A tiny scheduler which gives every site its own worker lane.
+
+Each lane is a thread with its own job queue, and requests of a lane are
+rate-limited by the bucket of its host (see ratelimit.py), so a slow (or
+strictly rate-limited) site only slows down its own lane. Lanes run
+in parallel, hence the total time is decided by the busiest site instead of
+the sum of all sites.
+"""
+
+
+class Scheduler(object):
+
+    def __init__(self, lanes):
+        """
+        @param lanes: dict, lane name -> fetch function.
+               The fetch function takes one argument (usually an id).
+        """
+
+        self.queues = {}
+        self.threads = []
+        self.pending = 0
+        self.cond = threading.Condition()
+        for name, func in lanes.items():
+            self.queues[name] = queue.Queue()
+            thread = threading.Thread(target=self._work, args=(name, func), daemon=True)
+            self.threads.append(thread)
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, name, arg, callback):
+        """
+        Add a job to a lane.
+
+        @param name: string, lane name.
+        @param arg: the argument passed to the fetch function of the lane.
+        @param callback: a function, called with the fetched result in the lane thread.
+               It's allowed to submit new jobs inside the callback.
+        """
+
+        with self.cond:
+            self.pending += 1
+        self.queues[name].put((arg, callback))
+
+    def wait(self):
+        """
+        Block until all submitted jobs (including jobs submitted by callbacks) are done.
+        """
+
+        with self.cond:
+            while self.pending > 0:
+                self.cond.wait()
+
+    def close(self):
+        for q in self.queues.values():
+            q.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def _work(self, name, func):
+        q = self.queues[name]
+        while True:
+            job = q.get()
+            if job is None:
+                break
+            arg, callback = job
+            try:
+                result = func(arg)
+            except Exception:
+                traceback.print_exc()
+                result = None
+            try:
+                callback(result)
+            except Exception:
+                print('{}: {}'.format(name, arg))
+                traceback.print_exc()
+            with self.cond:
+                self.pending -= 1
+                self.cond.notify_all()
@@ -0,0 +1,74 @@
+import threading
+import requests
+
+from requests.adapters import HTTPAdapter
+
+
+"""
+Shared HTTP session for all fetchers.
+
+A single requests.Session keeps connections alive, so requests to the same
+host reuse the TCP/TLS connection instead of handshaking every time.
+"""
+
+headers = {
+    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_6) \
+    AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0.1 Safari/605.1.15'
+}
+# (connect timeout, read timeout) in seconds, used if a request does not give one
+timeout = (10, 60)
+# max connections kept alive for each host, a host not listed uses default_pool_size
+pool_sizes = {
+    'https://api.jikan.moe': 4,
+    'http://api.bgm.tv': 8,
+    'https://bgm.tv': 2,
+    'https://graphql.anilist.co': 4,
+    'https://cdn.animenewsnetwork.com': 2,
+    'https://www.anikore.jp': 2,
+}
+default_pool_size = 4
+
+
+class TimeoutSession(requests.Session):
+    """
+    requests.Session with a default timeout.
+    """
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', timeout)
+        return super().request(method, url, **kwargs)
+
+
+def create_session():
+    """
+    Create a new session, with default headers, timeout and per-host connection pools.
+
+    @return: requests.Session.
+    """
+
+    sess = TimeoutSession()
+    sess.headers.update(headers)
+    default_adapter = HTTPAdapter(pool_connections=16, pool_maxsize=default_pool_size)
+    sess.mount('http://', default_adapter)
+    sess.mount('https://', default_adapter)
+    for prefix, size in pool_sizes.items():
+        sess.mount(prefix, HTTPAdapter(pool_connections=1, pool_maxsize=size))
+    return sess
+
+
+shared_session = None
+shared_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Get the shared session, create it at the first call.
+
+    @return: requests.Session.
+    """
+
+    global shared_session
+    with shared_session_lock:
+        if shared_session is None:
+            shared_session = create_session()
+        return shared_session
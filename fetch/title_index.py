@@ -0,0 +1,296 @@
+import re
+import json
+import datetime
+import unicodedata
+
+from collections import Counter
+from . import utils, cache_store, bangumi, anime_news_network, anikore, anidb
+
+
+"""
+Offline fuzzy title index.
+
+Matching an anime to another site through its search API costs a request per
+name, plus more requests to break ties. A TitleIndex is built once from what
+we already have (cached Bangumi, ANN and Anikore details, the AniDB title
+dump), then a name is matched locally: titles sharing the most n-grams with
+the query are picked from the postings, and re-ranked by LCS over the length
+of the longer title (see utils.lcs_ratios), so a title merely contained in
+the query (or containing it), like the first season of a sequel, doesn't
+score 1.
+"""
+
+gram_size = 3
+# candidates kept after counting shared n-grams, to be re-ranked by LCS
+rerank_size = 50
+# languages of AniDB titles to be indexed
+anidb_langs = set(('ja', 'x-jat', 'en'))
+number_pattern = re.compile(r'\d+')
+date_pattern = re.compile(r'(\d{4})(?:-(\d{1,2}))?(?:-(\d{1,2}))?')
+
+
+def normalize(title):
+    """
+    Fold width and case, and squash spaces, so 'ＡＢＣ  d' matches 'abc d'.
+    """
+
+    return ' '.join(unicodedata.normalize('NFKC', title).lower().split())
+
+
+def numbers(title):
+    """
+    @return: list of numbers in a title as strings, e.g. season numbers, leading zeros removed.
+    """
+
+    return [m.lstrip('0') or '0' for m in number_pattern.findall(title)]
+
+
+def air_day(air_date):
+    """
+    Day number of an air date, so air dates of different sites can be compared.
+
+    @param air_date: string starting with yyyy, yyyy-mm or yyyy-mm-dd (e.g. air_from of
+           MAL, or an ANN vintage like '2013-04-07 to 2013-09-28'), or int, a year.
+    @return: int, days since 0001-01-01, a missing month or day is taken as the
+             middle of the year. None if unknown.
+    """
+
+    if air_date is None:
+        return None
+    match_obj = date_pattern.match(str(air_date).strip())
+    if match_obj is None:
+        return None
+    try:
+        return datetime.date(int(match_obj.group(1)), int(match_obj.group(2) or 7),
+                             int(match_obj.group(3) or 1)).toordinal()
+    except ValueError:
+        return None
+
+
+def grams(title, n=gram_size):
+    """
+    @return: set of n-grams of a normalized title, padded by spaces.
+    """
+
+    padded = ' ' + title + ' '
+    if len(padded) <= n:
+        return set((padded,))
+    return set(padded[i:i + n] for i in range(len(padded) - n + 1))
+
+
+class TitleIndex(object):
+
+    def __init__(self, n=gram_size):
+        """
+        @param n: int, size of n-grams.
+        """
+
+        self.n = n
+        # entry -> (site id, normalized title)
+        self.entries = []
+        self.seen = set()
+        # n-gram -> list of entries
+        self.postings = {}
+        # site id -> air_day, to break ties
+        self.days = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, site_id, title, air_date=None):
+        """
+        Add a title of an anime. An anime can have many titles.
+
+        @param site_id: int, id of the anime on the indexed site.
+        @param title: string.
+        @param air_date: string or int, see air_day. Used by match to break ties.
+        """
+
+        day = air_day(air_date)
+        if day is not None:
+            self.days[site_id] = day
+        if not title:
+            return
+        title = normalize(title)
+        if (site_id, title) in self.seen:
+            return
+        self.seen.add((site_id, title))
+        entry = len(self.entries)
+        self.entries.append((site_id, title))
+        for gram in grams(title, self.n):
+            self.postings.setdefault(gram, []).append(entry)
+
+    def search(self, query, limit=10, min_score=0.0, min_length_ratio=None, same_numbers=False):
+        """
+        Search anime by a name.
+
+        @param query: string.
+        @param limit: int, max number of results.
+        @param min_score: float, results with a lower LCS ratio are dropped.
+        @param min_length_ratio: float, see utils.lcs_ratios.
+        @param same_numbers: boolean, drop titles whose numbers differ from the query's,
+               e.g. "season 3" never matches "season 2" however close they are.
+        @return: list of tuples (site id, score, matched title), best first, one for each anime.
+                 The matched title is normalized.
+        """
+
+        if not query:
+            return []
+        query = normalize(query)
+        counter = Counter()
+        for gram in grams(query, self.n):
+            counter.update(self.postings.get(gram, ()))
+        candidates = [entry for entry, _ in counter.most_common(rerank_size)]
+        scores = utils.lcs_ratios(query, [self.entries[entry][1] for entry in candidates], min_length_ratio,
+                                  by_longer=True)
+        query_numbers = numbers(query) if same_numbers else None
+        best = {}
+        for entry, score in zip(candidates, scores):
+            site_id, title = self.entries[entry]
+            if same_numbers and score >= min_score and numbers(title) != query_numbers:
+                continue
+            if score >= min_score and (site_id not in best or score > best[site_id][0]):
+                best[site_id] = (score, title)
+        result = [(site_id, score, title) for site_id, (score, title) in best.items()]
+        # for equal scores, prefer the one with closer length
+        result.sort(key=lambda x: (-x[1], abs(len(x[2]) - len(query))))
+        return result[:limit]
+
+    def match(self, names, min_score=0.8, air_date=None):
+        """
+        Find the anime best matching any of the names.
+        Like bangumi.search_for_anime, ties are broken by the air date closer to
+        air_date, and an anime with unknown air date loses a tie.
+
+        @param names: list of strings (None is allowed), e.g. jp_name, en_name and title from MAL.
+        @param min_score: float, min LCS ratio to accept.
+        @param air_date: string or int, see air_day.
+        @return: tuple (site id, score), or None if nothing matched.
+        """
+
+        scores = {}
+        for name in names:
+            for site_id, score, _ in self.search(name, 10, min_score, same_numbers=True):
+                scores[site_id] = max(score, scores.get(site_id, 0))
+        if not scores:
+            return None
+        best_score = max(scores.values())
+        tied = [site_id for site_id, score in scores.items() if best_score - score < 1e-6]
+        day = air_day(air_date)
+        if len(tied) > 1 and day is not None:
+            tied.sort(key=lambda site_id: abs(self.days[site_id] - day) if site_id in self.days else float('inf'))
+        return tied[0], best_score
+
+    def save(self, fpath):
+        with open(fpath, 'w', encoding='utf-8') as f:
+            json.dump({'n': self.n, 'entries': self.entries, 'days': list(self.days.items())}, f, ensure_ascii=False)
+
+
+def load(fpath):
+    """
+    Load an index saved by TitleIndex.save, postings are rebuilt.
+
+    @return: TitleIndex.
+    """
+
+    with open(fpath, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    index = TitleIndex(data['n'])
+    for site_id, title in data['entries']:
+        index.add(site_id, title)
+    index.days = dict((site_id, day) for site_id, day in data.get('days', []))
+    return index
+
+
+def iter_details(cache_dir, version, parse):
+    """
+    Yield cached details of a site, entries which are not parsed (or failed to parse) are skipped.
+
+    @param parse: a function, (raw payload, key) -> detail.
+    @return: a generator of tuples (key, detail).
+    """
+
+    for key in cache_store.keys(cache_dir):
+        detail = cache_store.peek_detail(cache_dir, key, version, lambda body: parse(body, key))
+        if detail is not None:
+            yield key, detail
+
+
+def build_bangumi(cache_dir, index=None):
+    """
+    Index cached Bangumi details.
+
+    @param cache_dir: string, cache directory used by bangumi.get_anime_detail.
+    @param index: TitleIndex to add to. If None, create one.
+    @return: TitleIndex.
+    """
+
+    if index is None:
+        index = TitleIndex()
+    for _, detail in iter_details(cache_dir, bangumi.parser_version, lambda body, key: bangumi.parse_data(body)):
+        index.add(detail['id'], detail['jp_name'], detail['air_from'])
+        index.add(detail['id'], detail['cn_name'])
+    return index
+
+
+def build_ann(cache_dir, index=None):
+    """
+    Index cached Anime News Network details.
+
+    @param cache_dir: string, cache directory used by anime_news_network.
+    @param index: TitleIndex to add to. If None, create one.
+    @return: TitleIndex.
+    """
+
+    if index is None:
+        index = TitleIndex()
+    for _, detail in iter_details(cache_dir, anime_news_network.parser_version,
+                                  lambda body, key: anime_news_network.parse_data(body)):
+        for title in detail['titles']:
+            index.add(detail['id'], title, detail.get('air'))
+    return index
+
+
+def build_anikore(cache_dir, index=None):
+    """
+    Index cached Anikore details.
+
+    @param cache_dir: string, cache directory used by anikore.get_anime_detail.
+    @param index: TitleIndex to add to. If None, create one.
+    @return: TitleIndex.
+    """
+
+    if index is None:
+        index = TitleIndex()
+    for key, detail in iter_details(cache_dir, anikore.parser_version, anikore.parse_data):
+        index.add(int(key), detail.get('jp_name') or detail['title'], detail['year'])
+    return index
+
+
+def build_anidb(fpath='anime-titles.xml.gz', index=None):
+    """
+    Index the AniDB title dump.
+
+    @param fpath: string, path of the dump, see anidb.download_all_anime_list.
+    @param index: TitleIndex to add to. If None, create one.
+    @return: TitleIndex.
+    """
+
+    if index is None:
+        index = TitleIndex()
+    for anime in anidb.iter_all_anime(fpath):
+        for title in anime['titles']:
+            if title['lang'] in anidb_langs:
+                index.add(int(anime['aid']), title['title'])
+    return index
+
+
+if __name__ == '__main__':
+    """
+    Just for testing.
+    """
+
+    # index = build_bangumi('bgm')
+    # print(len(index))
+    # print(index.search('進撃の巨人'))
+    # print(index.match(['Shingeki no Kyojin', '進撃の巨人']))
@@ -1,3 +1,56 @@
+import io
+import re
+
+from html import unescape
+from xml.etree import ElementTree
+
+try:
+    import lxml  # noqa: F401
+    # lxml is much faster than html.parser, use it if installed
+    html_parser = 'lxml'
+except ImportError:
+    html_parser = 'html.parser'
+
+# the first link of an HTML fragment
+href_pattern = re.compile(r'<a\b[^>]*?\bhref=["\']([^"\']*)["\']')
+
+
+def match_masks(a):
+    """
+    Bit masks of each char in a string, used by bit-parallel LCS.
+
+    @param a: string.
+    @return: dict, char -> int, bit i is set if a[i] is the char.
+    """
+
+    masks = {}
+    for i, c in enumerate(a):
+        masks[c] = masks.get(c, 0) | (1 << i)
+    return masks
+
+
+def lcs_masks(masks, len_a, b):
+    """
+    Length of LCS of a and b, where a is given by its match_masks.
+    Bit-parallel (Allison-Dix / Crochemore et al.), each char of b costs a few
+    big-int operations instead of a row of the DP table.
+
+    @param masks: dict, match_masks(a).
+    @param len_a: int, len(a).
+    @param b: string.
+    @return: int, length of LCS.
+    """
+
+    full = (1 << len_a) - 1
+    v = full
+    for c in b:
+        m = masks.get(c)
+        if m is not None:
+            u = v & m
+            v = ((v + u) | (v - u)) & full
+    return len_a - bin(v).count('1')
+
+
 def lcs(a, b):
     """
     Longest Common Subsequence.
@@ -9,15 +62,117 @@ def lcs(a, b):
 
     if type(a) != str or type(b) != str:
         return -1
-    
-    len_a = len(a)
-    len_b = len(b)
-    dp = [[0 for _ in range(len_b + 1)] for _ in range(len_a + 1)]
-    for i in range(1, len_a + 1):
-        for j in range(1, len_b + 1):
-            if a[i-1] == b[j-1]:
-                dp[i][j] = dp[i-1][j-1] + 1
-            else:
-                dp[i][j] = max(dp[i-1][j], dp[i][j-1])
-    
-    return dp[-1][-1]
\ No newline at end of file
+    # the shorter one as bits
+    if len(a) > len(b):
+        a, b = b, a
+    return lcs_masks(match_masks(a), len(a), b)
+
+
+def lcs_ratios(query, candidates, min_length_ratio=None, by_longer=False):
+    """
+    Score many candidates against one query, by LCS / length of the shorter string.
+
+    @param query: string.
+    @param candidates: list of strings.
+    @param min_length_ratio: float, if given, candidates whose length ratio to the
+           query (shorter / longer) is less than it are skipped with score 0.
+    @param by_longer: boolean, divide by the length of the longer string instead.
+           Then only equal strings score 1, while by the shorter one, any string
+           containing the other (e.g. a sequel title and the first season) scores 1.
+    @return: list of float, one for each candidate.
+    """
+
+    masks = match_masks(query)
+    len_q = len(query)
+    scores = []
+    for cand in candidates:
+        shorter = min(len_q, len(cand))
+        longer = max(len_q, len(cand))
+        if shorter == 0:
+            scores.append(0)
+            continue
+        if min_length_ratio is not None and shorter / longer < min_length_ratio:
+            scores.append(0)
+            continue
+        scores.append(lcs_masks(masks, len_q, cand) / (longer if by_longer else shorter))
+    return scores
+
+
+def iter_elements(source, tag):
+    """
+    Parse XML in a streaming way, yield each element with the given tag as soon
+    as it's complete. Elements are freed after the consumer moves on, so memory
+    stays flat however large the XML is.
+
+    @param source: bytes, a file path, or a file-like object (e.g. resp.raw).
+    @param tag: string, tag of elements to yield.
+    @return: a generator of xml.etree.ElementTree.Element.
+             Read what you need before fetching the next one.
+    """
+
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    context = ElementTree.iterparse(source, events=('start', 'end'))
+    _, root = next(context)
+    for event, elem in context:
+        if event == 'end' and elem.tag == tag:
+            yield elem
+            # drop everything parsed so far
+            root.clear()
+
+
+def strip_tags(html):
+    """
+    Get the text of an HTML fragment, like the .text of BeautifulSoup.
+
+    @param html: string, HTML-format text.
+    @return: string, with tags removed and entities unescaped.
+    """
+
+    return unescape(re.sub(r'<[^>]*>', '', html))
+
+
+def find_class(html, tag, cls, start=0, end=None):
+    """
+    Find the first tag with the given class, without parsing the whole page.
+
+    @param html: string, HTML-format text.
+    @param tag: string, tag name, e.g. 'div'.
+    @param cls: string, one of the classes of the tag.
+    @param start: int, where to start searching.
+    @param end: int, where to stop searching, default to the end of html.
+    @return: int, position right after the opening tag, or -1 if not found.
+    """
+
+    pattern = r'<%s\b[^>]*?\bclass=(["\'])(?:[^"\']*\s)?%s(?:\s[^"\']*)?\1[^>]*>' % (tag, re.escape(cls))
+    match_obj = re.compile(pattern).search(html, start, len(html) if end is None else end)
+    return match_obj.end() if match_obj else -1
+
+
+def find_end(html, tag, start):
+    """
+    Find the closing tag which matches an opening tag, nested tags of the same name are counted.
+
+    @param html: string, HTML-format text.
+    @param tag: string, tag name, e.g. 'div'.
+    @param start: int, position right after the opening tag (see find_class).
+    @return: int, position of the closing tag, or -1 if not found.
+    """
+
+    depth = 1
+    for match_obj in re.compile(r'<(/?)%s\b' % tag).finditer(html, start):
+        depth += -1 if match_obj.group(1) else 1
+        if depth == 0:
+            return match_obj.start()
+    return -1
+
+
+def find_href(html, start=0, end=None):
+    """
+    Get the href of the first link in html[start:end].
+
+    @return: string, or None if there is no link.
+    """
+
+    match_obj = href_pattern.search(html, start, len(html) if end is None else end)
+    return unescape(match_obj.group(1)) if match_obj else None
@@ -0,0 +1,446 @@
+import os
+import json
+import argparse
+import concurrent.futures
+
+from tqdm import tqdm
+from fetch import id_mapping, anime_news_network, anikore, anidb, bangumi, myanimelist, cache_store, title_index, utils
+
+
+"""
+Build id.mapping.json in stages:
+
+1. burstlink: download the burstlink mapping, which gives mal, anidb and anilist.
+2. ids: load id lists of ANN and Anikore, and titles of the AniDB dump.
+3. index: fetch details of all ANN and Anikore anime which are not cached yet
+   (ANN in batches of 50), then build title indexes of Bangumi, ANN and
+   Anikore from cached details. Bangumi has no id list, so its index only
+   knows what the updater cached.
+4. match: match each anime to those sites by its MAL and AniDB titles, in
+   worker processes. Ties are broken by the air date closer to MAL's. Anime
+   still without a bgm id are searched by the Bangumi search api.
+5. merge: merge everything into the mapping, and diff it against the previous one.
+   A matched id already used by another anime is rejected, and reported in the diff.
+
+Each stage saves its output in the work directory and is skipped if the
+output exists, so an interrupted build goes on from where it stopped. The
+match stage appends one record per anime to a log, and skips anime already
+in the log.
+"""
+
+WORK_DIR = 'mapping.build'
+MAPPING_PATH = 'id.mapping.json'
+MAL_DIR = 'fetch/mal'
+# site -> cache dir of its details, from which the title index of the site is built
+INDEXED_SITES = {
+    'bgm': 'fetch/bgm',
+    'ann': 'fetch/ann',
+    'anikore': 'fetch/anikore',
+}
+INDEX_BUILDERS = {
+    'bgm': title_index.build_bangumi,
+    'ann': title_index.build_ann,
+    'anikore': title_index.build_anikore,
+}
+SITES = ('mal', 'anidb', 'anilist', 'ann', 'bgm', 'anikore')
+CHUNK_SIZE = 200
+
+
+def checkpoint(fpath, build):
+    """
+    Load the output of a stage, or build it and save it.
+
+    @param fpath: string, path of the output (json).
+    @param build: a function, returns the output.
+    @return: the output.
+    """
+
+    if os.path.exists(fpath):
+        with open(fpath, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    data = build()
+    tmp_path = fpath + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, fpath)
+    return data
+
+
+def stage_burstlink(work_dir):
+    """
+    @return: dict, uid -> {'mal', 'anidb', 'anilist', 'ann'}, from burstlink.
+    """
+
+    fpath = os.path.join(work_dir, 'burstlink.json')
+    if not os.path.exists(fpath):
+        if not id_mapping.download_burstlink_mapping(fpath + '.tmp'):
+            raise RuntimeError('Failed to download the burstlink mapping.')
+        os.replace(fpath + '.tmp', fpath)
+    with open(fpath, 'r', encoding='utf-8') as f:
+        burstlink = json.load(f)
+    base = {}
+    for item in burstlink:
+        if item.get('mal') is None:
+            continue
+        base[str(item['mal'])] = {site: item.get(site) for site in ('mal', 'anidb', 'anilist', 'ann')}
+    return base
+
+
+def stage_ids(work_dir, anidb_dump):
+    """
+    @return: tuple (dict, site -> list of ids, for ann and anikore;
+             dict, aid (string) -> list of titles, from the AniDB dump).
+    """
+
+    def load_ids():
+        ann_ids = anime_news_network.get_all_anime_id_list()
+        anikore_ids = anikore.get_all_anime_list()
+        if ann_ids is None or anikore_ids is None:
+            raise RuntimeError('Failed to load id lists.')
+        return {'ann': [int(i) for i in ann_ids], 'anikore': [int(i) for i in anikore_ids]}
+
+    def load_anidb_titles():
+        if not os.path.exists(anidb_dump) and not anidb.download_all_anime_list(anidb_dump):
+            raise RuntimeError('Failed to download the AniDB dump.')
+        titles = {}
+        for anime in anidb.iter_all_anime(anidb_dump):
+            titles[anime['aid']] = [t['title'] for t in anime['titles'] if t['lang'] in title_index.anidb_langs]
+        return titles
+
+    ids = checkpoint(os.path.join(work_dir, 'ids.json'), load_ids)
+    anidb_titles = checkpoint(os.path.join(work_dir, 'anidb.titles.json'), load_anidb_titles)
+    return ids, anidb_titles
+
+
+def fetch_missing(site, site_ids):
+    """
+    Cache details of anime which are not cached yet, so they can be indexed.
+    Anime with a parsed record are skipped, so an interrupted fetch goes on from
+    where it stopped. A page which failed to parse is recorded with detail None
+    (see cache_store.parse_payload), so it's skipped too, while a raw page without
+    a parsed record (e.g. cached before the parse crashed) is loaded again.
+
+    @param site: string, 'ann' or 'anikore'.
+    @param site_ids: list of int, from stage_ids.
+    """
+
+    cache_dir = INDEXED_SITES[site]
+    parsed_dir = cache_store.parsed_dir(cache_dir)
+    todo = [site_id for site_id in site_ids if not cache_store.exists(parsed_dir, site_id)]
+    if not todo:
+        return
+    print('{}: fetching {} anime not cached yet'.format(site, len(todo)))
+    if site == 'ann':
+        anime_news_network.cache_anime_detail_list([str(site_id) for site_id in todo], cache_dir)
+    else:
+        # no batch api, one page per anime
+        for site_id in tqdm(todo):
+            anikore.get_anime_detail(site_id, True, cache_dir)
+
+
+def stage_index(work_dir, ids):
+    """
+    @param ids: dict, site -> list of ids, from stage_ids.
+    @return: dict, site -> path of its saved title index.
+    """
+
+    index_paths = {}
+    for site, cache_dir in INDEXED_SITES.items():
+        fpath = os.path.join(work_dir, 'index.{}.json'.format(site))
+        if not os.path.exists(fpath):
+            if site in ids:
+                fetch_missing(site, ids[site])
+            index = INDEX_BUILDERS[site](cache_dir)
+            print('{}: {} titles indexed'.format(site, len(index)))
+            index.save(fpath + '.tmp')
+            os.replace(fpath + '.tmp', fpath)
+        index_paths[site] = fpath
+    return index_paths
+
+
+worker_indexes = None
+worker_min_score = None
+
+
+def init_worker(index_paths, min_score):
+    """
+    Load the title indexes once in each worker process.
+    """
+
+    global worker_indexes, worker_min_score
+    worker_indexes = {site: title_index.load(fpath) for site, fpath in index_paths.items()}
+    worker_min_score = min_score
+
+
+def match_chunk(chunk):
+    """
+    Match a chunk of anime, in a worker process.
+
+    @param chunk: list of tuples (uid, names, MAL air date, sites to match).
+    @return: list of tuples (uid, {site: [site id, score] or None}).
+    """
+
+    result = []
+    for uid, names, air_date, sites in chunk:
+        matched = {}
+        for site in sites:
+            best = worker_indexes[site].match(names, worker_min_score, air_date)
+            matched[site] = list(best) if best is not None else None
+        result.append((uid, matched))
+    return result
+
+
+def get_mal_detail(uid):
+    return cache_store.peek_detail(MAL_DIR, uid, myanimelist.parser_version, myanimelist.parse_data)
+
+
+def get_names(uid, entry, anidb_titles):
+    """
+    @return: tuple (list of names of an anime, from cached MAL detail and the AniDB dump;
+             MAL air date or None).
+    """
+
+    names = []
+    air_date = None
+    detail = get_mal_detail(uid)
+    if detail is not None:
+        names.extend([detail['jp_name'], detail['title'], detail['en_name']])
+        air_date = detail['air_from']
+    if entry['anidb'] is not None:
+        names.extend(anidb_titles.get(str(entry['anidb']), []))
+    return [name for name in names if name], air_date
+
+
+def search_bgm(uid, min_score):
+    """
+    Search an anime by the Bangumi search api, for anime the index failed to match.
+    The result is only accepted if one of its names matches a MAL name by min_score,
+    scored the same way as the title index.
+
+    @return: list [bgm id, score], or None.
+    """
+
+    detail = get_mal_detail(uid)
+    if detail is None:
+        return None
+    result = bangumi.search_for_anime(detail['jp_name'], detail['en_name'], detail['air_from'], True,
+                                      INDEXED_SITES['bgm'])
+    if result is None:
+        return None
+    names = [title_index.normalize(name) for name in (detail['jp_name'], detail['title'], detail['en_name']) if name]
+    titles = [title_index.normalize(name) for name in (result['jp_name'], result['cn_name']) if name]
+    score = max([0] + [max(utils.lcs_ratios(name, titles, by_longer=True)) for name in names if titles])
+    return [result['id'], score] if score >= min_score else None
+
+
+def stage_match(work_dir, base, previous, anidb_titles, index_paths, args):
+    """
+    @return: dict, uid -> {site: [site id, score] or None}, for anime which needed matching.
+    """
+
+    log_path = os.path.join(work_dir, 'matches.jsonl')
+    matches = {}
+    # uids already searched by the Bangumi search api
+    searched = set()
+    if os.path.exists(log_path):
+        with open(log_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last line may be cut off by an interruption
+                    continue
+                matches.setdefault(record['uid'], {}).update(record['matched'])
+                if record.get('searched'):
+                    searched.add(record['uid'])
+
+    tasks = []
+    no_name = 0
+    for uid, entry in base.items():
+        if uid in matches:
+            continue
+        old = previous.get(uid, {})
+        sites = [site for site in INDEXED_SITES
+                 if entry.get(site) is None and (args.rematch or old.get(site) is None)]
+        if not sites:
+            continue
+        names, air_date = get_names(uid, entry, anidb_titles)
+        if not names:
+            no_name += 1
+            continue
+        tasks.append((uid, names, air_date, sites))
+    print('{} anime to match, {} skipped without any known name'.format(len(tasks), no_name))
+
+    chunks = [tasks[i:i + CHUNK_SIZE] for i in range(0, len(tasks), CHUNK_SIZE)]
+    with open(log_path, 'a', encoding='utf-8') as log_file, \
+            concurrent.futures.ProcessPoolExecutor(args.workers, initializer=init_worker,
+                                                   initargs=(index_paths, args.min_score)) as executor:
+        futures = [executor.submit(match_chunk, chunk) for chunk in chunks]
+        for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures)):
+            for uid, matched in future.result():
+                matches[uid] = matched
+                log_file.write(json.dumps({'uid': uid, 'matched': matched}, ensure_ascii=False) + '\n')
+            log_file.flush()
+
+    if args.skip_bgm_search:
+        return matches
+    todo = [uid for uid, matched in matches.items()
+            if 'bgm' in matched and matched['bgm'] is None and uid not in searched]
+    print('{} anime to search on Bangumi'.format(len(todo)))
+    with open(log_path, 'a', encoding='utf-8') as log_file:
+        for uid in tqdm(todo):
+            matched = {'bgm': search_bgm(uid, args.min_score)}
+            matches[uid].update(matched)
+            log_file.write(json.dumps({'uid': uid, 'matched': matched, 'searched': True}, ensure_ascii=False) + '\n')
+            log_file.flush()
+    return matches
+
+
+def stage_merge(base, previous, matches, ids, rematch=False):
+    """
+    Merge burstlink, matched ids and the previous mapping.
+    Ids from burstlink come first, then matched ids (dropped if no longer in the
+    id list of the site), then the previous mapping. Anime only in the previous
+    mapping are kept.
+    A matched id is rejected if another anime already has it, or if another anime
+    matched it with a higher score.
+
+    @return: tuple (dict, the new mapping; list of rejected matches).
+    """
+
+    valid_ids = {site: set(site_ids) for site, site_ids in ids.items()}
+    mapping = {}
+    # site -> {site id: list of (score, uid)}, matched ids to be given out
+    proposals = {site: {} for site in INDEXED_SITES}
+    for uid in list(base) + [uid for uid in previous if uid not in base]:
+        entry = base.get(uid, {})
+        old = previous.get(uid, {})
+        matched = matches.get(uid, {})
+        item = {}
+        for site in SITES:
+            value = entry.get(site)
+            if value is None and matched.get(site) is not None:
+                site_id, score = matched[site]
+                if site not in valid_ids or site_id in valid_ids[site]:
+                    proposals[site].setdefault(site_id, []).append((score, uid))
+                    # decided below
+                    item[site] = None
+                    continue
+            if value is None and not (rematch and site in matched):
+                value = old.get(site)
+            item[site] = value
+        mapping[uid] = item
+
+    rejected = []
+    for site, site_proposals in proposals.items():
+        owners = {}
+        for uid, item in mapping.items():
+            if item[site] is not None:
+                owners.setdefault(item[site], uid)
+        for site_id, candidates in site_proposals.items():
+            candidates.sort(key=lambda x: -x[0])
+            if site_id in owners:
+                winners, losers = [], candidates
+            else:
+                winners, losers = candidates[:1], candidates[1:]
+            for _, uid in winners:
+                mapping[uid][site] = site_id
+            for score, uid in losers:
+                rejected.append({'uid': uid, 'site': site, 'id': site_id, 'score': score,
+                                 'owner': owners.get(site_id, winners[0][1] if winners else None)})
+    return mapping, rejected
+
+
+def duplicates(mapping):
+    """
+    @return: dict, site -> {site id: list of uids}, ids shared by more than one anime.
+    """
+
+    result = {}
+    for site in SITES:
+        owners = {}
+        for uid, item in mapping.items():
+            if item.get(site) is not None:
+                owners.setdefault(item[site], []).append(uid)
+        shared = {site_id: uids for site_id, uids in owners.items() if len(uids) > 1}
+        if shared:
+            result[site] = shared
+    return result
+
+
+def diff_mapping(old, new):
+    """
+    @param old: dict, the previous mapping.
+    @param new: dict, the new mapping.
+    @return: dict, with added and removed uids, changed ids, and ids shared by
+             more than one anime in the new mapping.
+    """
+
+    changes = []
+    for uid, item in new.items():
+        if uid not in old:
+            continue
+        for site in SITES:
+            if old[uid].get(site) != item[site]:
+                changes.append({'uid': uid, 'site': site, 'old': old[uid].get(site), 'new': item[site]})
+    return {
+        'added': [uid for uid in new if uid not in old],
+        'removed': [uid for uid in old if uid not in new],
+        'changed': changes,
+        'duplicates': duplicates(new),
+    }
+
+
+def build(args):
+    os.makedirs(args.work_dir, exist_ok=True)
+    previous = {}
+    if os.path.exists(args.output):
+        with open(args.output, 'r', encoding='utf-8') as f:
+            previous = json.load(f)
+
+    base = stage_burstlink(args.work_dir)
+    ids, anidb_titles = stage_ids(args.work_dir, args.anidb_dump)
+    index_paths = stage_index(args.work_dir, ids)
+    matches = stage_match(args.work_dir, base, previous, anidb_titles, index_paths, args)
+    mapping, rejected = stage_merge(base, previous, matches, ids, args.rematch)
+
+    diff = diff_mapping(previous, mapping)
+    diff['rejected'] = rejected
+    with open(os.path.join(args.work_dir, 'mapping.diff.json'), 'w', encoding='utf-8') as f:
+        json.dump(diff, f, indent=2, ensure_ascii=False)
+    changed_sites = {}
+    for change in diff['changed']:
+        changed_sites[change['site']] = changed_sites.get(change['site'], 0) + 1
+    print('{} anime: {} added, {} removed, changed ids: {}'.format(
+        len(mapping), len(diff['added']), len(diff['removed']), changed_sites))
+    print('{} matches rejected as taken by other anime, ids shared by more than one anime: {}'.format(
+        len(rejected), {site: len(shared) for site, shared in diff['duplicates'].items()}))
+
+    if not args.dry_run:
+        tmp_path = args.output + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(mapping, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, args.output)
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--output', default=MAPPING_PATH,
+        help='The mapping to update, also the previous mapping to diff against')
+    arg_parser.add_argument('--work_dir', default=WORK_DIR,
+        help='Directory for outputs of stages, remove it to rebuild from scratch')
+    arg_parser.add_argument('--anidb_dump', default='anime-titles.xml',
+        help='The AniDB title dump, downloaded if not exists')
+    arg_parser.add_argument('--workers', type=int, default=os.cpu_count(),
+        help='Number of worker processes for matching')
+    arg_parser.add_argument('--min_score', type=float, default=0.8,
+        help='Min LCS ratio to accept a matched title')
+    arg_parser.add_argument('--rematch', action='store_true', default=False,
+        help='Match bgm/ann/anikore again instead of keeping ids of the previous mapping')
+    arg_parser.add_argument('--skip_bgm_search', action='store_true', default=False,
+        help='Do not search anime the index failed to match by the Bangumi search api')
+    arg_parser.add_argument('--dry_run', action='store_true', default=False,
+        help='Only write the diff, keep the mapping untouched')
+    args = arg_parser.parse_args()
+
+    build(args)
@@ -0,0 +1,80 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mapping_builder
+from fetch import anikore, cache_store, ratelimit, title_index
+
+
+def anikore_page(title, year):
+    return (
+        '<section class="l-animeDetailHeader"><h1>「{}（TVアニメ動画）」</h1></section>'
+        '<div class="l-animeDetailHeader_pointAndButtonBlock_starBlock"><strong>4.2</strong> <a href="/r">1234</a></div>'
+        '<ul class="l-breadcrumb_flexRoot"><li><a href="/">top</a></li><li><a href="/anime">anime</a></li>'
+        '<li><a href="/chronicle/{}/">{}</a></li></ul>'
+    ).format(title, year, year)
+
+
+class Response(object):
+
+    def __init__(self, text):
+        self.text = text
+        self.status_code = 200
+        self.headers = {}
+
+
+class StageIndexResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.work_dir, 'anikore')
+        self.patches = [
+            mock.patch.object(mapping_builder, 'INDEXED_SITES', {'anikore': self.cache_dir}),
+            mock.patch.object(mapping_builder, 'INDEX_BUILDERS', {'anikore': title_index.build_anikore}),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        shutil.rmtree(self.work_dir)
+
+    def test_resume_with_bad_cached_page(self):
+        # 1 is cached and parsed, 2 is a raw page of an unknown layout cached without
+        # a parsed record, 3 is not cached yet
+        cache_store.save_detail(self.cache_dir, 1, anikore.parser_version, anikore_page('進撃の巨人', 2013),
+                                None, anikore.cache_ttl, lambda html: anikore.parse_data(html, 1))
+        cache_store.save(self.cache_dir, 2, '<html><p>This anime was removed.</p></html>', ttl=anikore.cache_ttl)
+        pages = {'https://www.anikore.jp/anime/3': anikore_page('ハイキュー!!', 2014)}
+        get = mock.Mock(side_effect=lambda url, **kwargs: Response(pages[url]))
+        ids = {'anikore': [1, 2, 3]}
+
+        with mock.patch.object(ratelimit, 'get', get):
+            index_paths = mapping_builder.stage_index(self.work_dir, ids)
+        self.assertEqual(get.call_count, 1)
+        index = title_index.load(index_paths['anikore'])
+        self.assertEqual(sorted(site_id for site_id, _ in index.entries), [1, 3])
+        # the bad page is recorded as parsed (detail None), so it's never loaded again
+        self.assertTrue(cache_store.exists(cache_store.parsed_dir(self.cache_dir), 2))
+        self.assertIsNone(cache_store.peek_detail(self.cache_dir, 2, anikore.parser_version,
+                                                  lambda html: anikore.parse_data(html, 2)))
+
+        # resume: nothing is fetched again, and the index is built again without the bad page
+        os.remove(index_paths['anikore'])
+        get.reset_mock()
+        with mock.patch.object(ratelimit, 'get', get):
+            index_paths = mapping_builder.stage_index(self.work_dir, ids)
+        get.assert_not_called()
+        index = title_index.load(index_paths['anikore'])
+        self.assertEqual(sorted(site_id for site_id, _ in index.entries), [1, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,14 @@
 import json
 import time
 import os
-import shutil
 import argparse
-import numpy as np
+import threading
+import asyncio
 
 from tqdm import tqdm
-from fetch import anime_news_network, myanimelist, bangumi, anilist, anikore
-from analyze import adjust, bayesian
+from fetch import anime_news_network, myanimelist, bangumi, anilist, anikore, ratelimit, aio, cache_store, mapping_index, parse_pool
+from fetch.scheduler import Scheduler
+from analyze import incremental
 
 
 MAL_DIR = 'fetch/mal'
@@ -15,143 +16,290 @@ BGM_DIR = 'fetch/bgm'
 ANN_DIR = 'fetch/ann'
 ANL_DIR = 'fetch/anilist'
 AKR_DIR = 'fetch/anikore'
+TMP_PATH = 'all.tmp.jsonl'
+
+# seconds a cached anime stays fresh in incremental mode, by MAL air status
+REFRESH_INTERVALS = {
+    'Currently Airing': 86400,
+    'Not yet aired': 86400 * 3,
+    'Finished Airing': 86400 * 30,
+}
+DEFAULT_REFRESH_INTERVAL = 86400 * 7
 
 
 def clear_cache():
     """
-    Clear local cache files.
+    Clear local cache.
+    """
+
+    for cache_dir in (MAL_DIR, BGM_DIR, ANN_DIR, ANL_DIR, AKR_DIR):
+        cache_store.clear(cache_dir)
+
+
+def refresh_cache(mapping):
+    """
+    Set how long cached entries stay fresh, instead of clearing all of them.
+    How often an anime is refreshed is decided by its MAL air status (see REFRESH_INTERVALS).
+    Out-of-date entries will be revalidated (or fetched again) in the next update.
+
+    @param mapping: mapping_index.MappingIndex (or dict), loaded from id.mapping.json.
+    @return: int, number of entries whose ttl changed.
+    """
+
+    changed = 0
+    for uid, item in tqdm(mapping.items()):
+        entry = cache_store.load(MAL_DIR, item['mal'])
+        if entry is None:
+            # not fetched yet
+            continue
+        air_status = entry['body'].get('status')
+        interval = REFRESH_INTERVALS.get(air_status, DEFAULT_REFRESH_INTERVAL)
+        # spread refreshes over time, or everything cached on the same day will be due on the same day
+        interval *= 0.75 + 0.5 * (int(item['mal']) % 100) / 100
+        keys = [(MAL_DIR, item['mal'])]
+        for key, cache_dir in (
+            ('ann', ANN_DIR),
+            ('bgm', BGM_DIR),
+            ('anilist', ANL_DIR),
+            ('anikore', AKR_DIR),
+        ):
+            if item[key] is not None:
+                keys.append((cache_dir, item[key]))
+        for cache_dir, site_id in keys:
+            if cache_store.set_ttl(cache_dir, site_id, interval):
+                changed += 1
+    return changed
+
+
+def load_checkpoint(fpath):
+    """
+    Load fetched data from a checkpoint log (JSON Lines, one record per uid).
+    Broken lines (e.g. the last line when crashed) are skipped.
+    Old-style checkpoints (a whole JSON dict, *.json) are also supported.
+
+    @param fpath: string, path to the checkpoint.
+    @return: dict, uid -> item data.
+    """
+
+    with open(fpath, 'r', encoding='utf-8') as f:
+        if fpath.endswith('.json'):
+            return json.load(f)
+        all_data = {}
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            all_data[record['uid']] = record['data']
+        return all_data
+
+
+def dump_checkpoint_record(f, uid, item_data):
+    f.write(json.dumps({'uid': uid, 'data': item_data}, ensure_ascii=False) + '\n')
+
+
+def compact_checkpoint(fpath, all_data):
+    """
+    Rewrite the checkpoint log with exactly one record per uid.
+    The file is replaced atomically, so a crash here won't break the old log.
+
+    @param fpath: string, path to the checkpoint.
+    @param all_data: dict, uid -> item data.
     """
 
-    if os.path.exists(MAL_DIR):
-        shutil.rmtree(MAL_DIR)
-    if os.path.exists(BGM_DIR):
-        shutil.rmtree(BGM_DIR)
-    if os.path.exists(ANN_DIR):
-        shutil.rmtree(ANN_DIR)
-    if os.path.exists(ANL_DIR):
-        shutil.rmtree(ANL_DIR)
-    if os.path.exists(AKR_DIR):
-        shutil.rmtree(AKR_DIR)
-    os.mkdir(MAL_DIR)
-    os.mkdir(BGM_DIR)
-    os.mkdir(ANN_DIR)
-    os.mkdir(ANL_DIR)
-    os.mkdir(AKR_DIR)
+    tmp_path = fpath + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for uid, item_data in all_data.items():
+            dump_checkpoint_record(f, uid, item_data)
+    os.replace(tmp_path, fpath)
+
 
+def prefetch(mapping, all_data):
+    """
+    Cache details in batches (50 titles per request) for sites supporting it
+    (ANN and AniList) before the per-uid loop, so get_anime_detail will hit the cache.
 
-def update_once(args, save_method, pre_data={}):
+    @param mapping: mapping_index.MappingIndex (or dict), loaded from id.mapping.json.
+    @param all_data: dict, uids already in it are skipped.
+    """
+
+    sites = [
+        ('ANN', 'ann', ANN_DIR, anime_news_network.cache_anime_detail_list),
+        ('AniList', 'anilist', ANL_DIR, anilist.cache_anime_detail_list),
+    ]
+    for site, key, cache_dir, cache_list in sites:
+        id_list = []
+        for uid, item in mapping.items():
+            if uid in all_data or item[key] is None:
+                continue
+            site_id = str(item[key])
+            if not cache_store.is_fresh(cache_store.load(cache_dir, site_id)):
+                id_list.append(site_id)
+        if id_list:
+            print('Prefetching {} titles from {}'.format(len(id_list), site))
+            cache_list(id_list, cache_dir)
+
+
+ALLOW_TYPES = set(('TV', 'Movie', 'OVA'))
+# site -> (key in mapping, module, cache dir), MAL is not listed since it's always requested first
+SITES = {
+    'ANN': ('ann', anime_news_network, ANN_DIR),
+    'BGM': ('bgm', bangumi, BGM_DIR),
+    'AniList': ('anilist', anilist, ANL_DIR),
+    'Anikore': ('anikore', anikore, AKR_DIR),
+}
+
+
+def new_item_data(mal_res):
+    return {
+        'MAL': mal_res,
+        'ANN': None,
+        'BGM': None,
+        'AniList': None,
+        'Anikore': None,
+    }
+
+
+def fetch_all_threaded(mapping, all_data, finish):
+    """
+    Fetch data of all anime in mapping, each site in its own thread lane.
+    MAL is requested first, other sites are requested only if the type is allowed.
+
+    @param mapping: mapping_index.MappingIndex (or dict), loaded from id.mapping.json.
+    @param all_data: dict, uids already in it are skipped.
+    @param finish: a function, called with (uid, item_data) when a uid is done.
+           item_data is None if the uid is dropped.
+    """
+
+    lanes = {'MAL': lambda mal_id: myanimelist.get_anime_detail(mal_id, True, MAL_DIR)}
+    for site, (key, module, cache_dir) in SITES.items():
+        lanes[site] = lambda site_id, module=module, cache_dir=cache_dir: module.get_anime_detail(site_id, True, cache_dir)
+
+    lock = threading.Lock()
+    scheduler = Scheduler(lanes)
+
+    def on_site_done(uid, item_data, site, remaining, result):
+        with lock:
+            item_data[site] = result
+            remaining[0] -= 1
+            done = remaining[0] == 0
+        if done:
+            finish(uid, item_data)
+
+    def on_mal_done(uid, item, mal_res):
+        if mal_res is None or mal_res['type'] not in ALLOW_TYPES:
+            finish(uid, None)
+            return
+        item_data = new_item_data(mal_res)
+        todo = [site for site, (key, _, _) in SITES.items() if item[key] is not None]
+        if not todo:
+            finish(uid, item_data)
+            return
+        remaining = [len(todo)]
+        for site in todo:
+            callback = lambda result, site=site: on_site_done(uid, item_data, site, remaining, result)
+            scheduler.submit(site, item[SITES[site][0]], callback)
+
+    scheduler.start()
+    for uid, item in mapping.items():
+        if uid in all_data:
+            continue
+        assert item['mal'] is not None
+        scheduler.submit('MAL', item['mal'], lambda mal_res, uid=uid, item=item: on_mal_done(uid, item, mal_res))
+    scheduler.wait()
+    scheduler.close()
+
+
+async def fetch_all_async(mapping, all_data, finish):
+    """
+    The same as fetch_all_threaded, but all requests run in one event loop.
+    All uids are in flight at once, and ratelimit decides when each request is sent.
+    """
+
+    async def fetch_item(uid, item):
+        assert item['mal'] is not None
+        mal_res = await myanimelist.async_get_anime_detail(item['mal'], True, MAL_DIR)
+        if mal_res is None or mal_res['type'] not in ALLOW_TYPES:
+            finish(uid, None)
+            return
+        item_data = new_item_data(mal_res)
+        todo = [site for site, (key, _, _) in SITES.items() if item[key] is not None]
+        results = await asyncio.gather(*[
+            SITES[site][1].async_get_anime_detail(item[SITES[site][0]], True, SITES[site][2]) for site in todo
+        ])
+        for site, result in zip(todo, results):
+            item_data[site] = result
+        finish(uid, item_data)
+
+    try:
+        await asyncio.gather(*[fetch_item(uid, item) for uid, item in mapping.items() if uid not in all_data])
+    finally:
+        await aio.close_session()
+
+
+def fetch_all(mapping, all_data, args):
+    """
+    Fetch data of all anime in mapping, using the engine given by args.engine.
+
+    @param mapping: mapping_index.MappingIndex (or dict), loaded from id.mapping.json.
+    @param all_data: dict, fetched data will be added here. Existed uids are skipped.
+    @param args: some args to be passed, as defined in arg_parser.
+    """
+
+    lock = threading.Lock()
+    pbar = tqdm(total=len(mapping))
+    pbar.update(len([uid for uid in mapping if uid in all_data]))
+    # start the log with data we already have, then append one record per uid
+    compact_checkpoint(TMP_PATH, all_data)
+    tmp_file = open(TMP_PATH, 'a', encoding='utf-8')
+
+    def finish(uid, item_data):
+        with lock:
+            if item_data is not None:
+                all_data[uid] = item_data
+                # save to tmp file
+                dump_checkpoint_record(tmp_file, uid, item_data)
+                tmp_file.flush()
+            pbar.update(1)
+
+    try:
+        if args.engine == 'async':
+            asyncio.run(fetch_all_async(mapping, all_data, finish))
+        else:
+            fetch_all_threaded(mapping, all_data, finish)
+    finally:
+        tmp_file.close()
+        pbar.close()
+
+
+def update_once(args, save_method, pre_data={}, scorer=None):
     """
     Update the data once.
 
     @param args: some args to be passed, as defined in arg_parser.
     @param save_method: a function, used for saving data to file/sql/oss.
     @param pre_data: a dict, loaded from tmp file.
+    @param scorer: incremental.IncrementalScorer, kept between updates to re-score
+           only what changed. If None, score everything from scratch.
     """
 
-    with open('id.mapping.json', 'r', encoding='utf-8') as f:
-        mapping = json.load(f)
+    mapping = mapping_index.load()
 
-    allow_types = set(('TV', 'Movie', 'OVA'))
-    
-    # fetch data
+    # fetch data, responses are parsed in worker processes unless args.parse_workers is 0
     all_data = pre_data
-    for uid, item in tqdm(mapping.items()):
-        start = time.time()
-        if uid in all_data:
-            continue
-        
-        assert item['mal'] is not None
-        mal_res = myanimelist.get_anime_detail(item['mal'], True, MAL_DIR)
-        if mal_res is None or mal_res['type'] not in allow_types:
-            time.sleep(args.delay)
-            continue
-        
-        if item['ann'] is not None:
-            ann_res = anime_news_network.get_anime_detail(item['ann'], True, ANN_DIR)
-        else:
-            ann_res = None
-        if item['bgm'] is not None:
-            bgm_res = bangumi.get_anime_detail(item['bgm'], True, BGM_DIR)
-        else:
-            bgm_res = None
-        if item['anilist'] is not None:
-            anl_res = anilist.get_anime_detail(item['anilist'], True, ANL_DIR)
-        else:
-            anl_res = None
-        if item['anikore'] is not None:
-            akr_res = anikore.get_anime_detail(item['anikore'], True, AKR_DIR)
-        else:
-            akr_res = None
-        
-        all_data[uid] = {
-            'MAL': mal_res,
-            'ANN': ann_res,
-            'BGM': bgm_res,
-            'AniList': anl_res,
-            'Anikore': akr_res,
-        }
-        # save to tmp file
-        with open('all.tmp.json', 'w', encoding='utf-8') as f:
-            json.dump(all_data, f, indent=2, ensure_ascii=False)
-        # request delay
-        end = time.time()
-        if end - start < args.delay:
-            time.sleep(args.delay - (end - start))
+    if args.parse_workers > 0:
+        parse_pool.start(args.parse_workers)
+    try:
+        prefetch(mapping, all_data)
+        fetch_all(mapping, all_data, args)
+    finally:
+        parse_pool.close()
     
-    # re-calculate the scores
-    # for bangumi
-    ids, ratings = [], []
-    for uid, item in all_data.items():
-        bgm = item['BGM']
-        if bgm is not None and bgm['rating_detail'] is not None:
-            ids.append(uid)
-            rating_detail = list(bgm['rating_detail'].values())
-            rating_detail.reverse()
-            ratings.append(rating_detail)
-    scores = bayesian.calc_bayesian_score(ratings, 10)
-    for uid, score in zip(ids, scores):
-        all_data[uid]['BGM']['bayesian_score'] = score
-    # for anilist
-    ids, ratings = [], []
-    for uid, item in all_data.items():
-        anl = item['AniList']
-        if anl is not None and anl['stats']['scoreDistribution']:
-            ids.append(uid)
-            rating_detail = [0 for _ in range(10)]
-            for stat in anl['stats']['scoreDistribution']:
-                rating_detail[int(stat['score'] / 10) - 1] = stat['amount']
-            all_data[uid]['AniList']['votes'] = int(np.sum(rating_detail))
-            ratings.append(rating_detail)
-    scores = bayesian.calc_bayesian_score(ratings, 10)
-    for uid, score in zip(ids, scores):
-        all_data[uid]['AniList']['bayesian_score'] = score
-    # for anikore
-    ids, ratings = [], [[], []]
-    for uid, item in all_data.items():
-        akr = item['Anikore']
-        if akr is not None and akr['score'] is not None:
-            ids.append(uid)
-            ratings[0].append(akr['score'] * 2)
-            ratings[1].append(akr['votes'])
-    scores = bayesian.calc_bayesian_score_by_average(ratings, 10)
-    for uid, score in zip(ids, scores):
-        all_data[uid]['Anikore']['bayesian_score'] = score
-
-    # normalize and average
-    all_data = adjust.adjust_scores(all_data)
-    min_count = 4
-    all_list = []
-    for uid, item in all_data.items():
-        count = 0
-        score_sum = 0
-        for site in item:
-            site_data = item[site]
-            if site_data is not None and 'adjusted_score' in site_data:
-                count += 1
-                score_sum += site_data['adjusted_score']
-        if count >= min_count:
-            item['score'] = score_sum / count
-            all_list.append(item)
+    # re-calculate the scores, only the affected ones if the scorer has seen the last update
+    if scorer is None:
+        scorer = incremental.IncrementalScorer()
+    scorer.sync(all_data)
+    all_list = scorer.result(all_data)
 
     # save
     save_method(all_list)
@@ -165,8 +313,10 @@ def always_update(args, save_method):
     @param save_method: a function, used for saving data to file/sql/oss.
     """
 
+    if args.cache_db != '':
+        cache_store.use_database(args.cache_db)
+
     myanimelist.jikan_api = args.jikan
-    myanimelist.req_delay = args.delay
     myanimelist.use_api_pool = args.jikan_use_api_pool
     if args.jikan_use_api_pool:
         if args.jikan_api_pool == '':
@@ -174,17 +324,25 @@ def always_update(args, save_method):
         myanimelist.jikan_api_pool = [url for url in args.jikan_api_pool.split(' ') if url != '']
         myanimelist.jikan_api = myanimelist.jikan_api_pool[0]
         myanimelist.jikan_api_idx = 0
+    for url in [myanimelist.jikan_api] + myanimelist.jikan_api_pool:
+        ratelimit.set_interval(url, args.delay)
 
     if args.checkpoint != '':
-        with open(args.checkpoint, 'r', encoding='utf-8') as f:
-            pre_data = json.load(f)
+        pre_data = load_checkpoint(args.checkpoint)
     else:
         pre_data = {}
+    # with --incremental, the scorer keeps its statistics between updates
+    scorer = incremental.IncrementalScorer() if args.incremental else None
     
     while True:
         start_time = time.time()
-        clear_cache()
-        update_once(args, save_method, pre_data)
+        if args.incremental:
+            mapping = mapping_index.load()
+            changed = refresh_cache(mapping)
+            print('Refresh interval changed for {} cache entries'.format(changed))
+        else:
+            clear_cache()
+        update_once(args, save_method, pre_data, scorer)
         end_time = time.time()
         time_spent = int(end_time - start_time)
         time_to_sleep = max(args.interval - time_spent, 0)
@@ -203,11 +361,19 @@ if __name__ == '__main__':
     arg_parser.add_argument('--jikan_api_pool', default='',
         help='Jikan api url pool, use space to divide urls')
     arg_parser.add_argument('--delay', type=float, default=4,
-        help='Delay seconds for requests')
+        help='Delay seconds for requests to MyAnimeList (Jikan)')
     arg_parser.add_argument('--interval', type=int, default=86400,
         help='Update interval (seconds)')
+    arg_parser.add_argument('--incremental', action='store_true', default=False,
+        help='Only refetch out-of-date cache and re-score changed anime each interval, instead of clearing all cache')
+    arg_parser.add_argument('--cache_db', default='',
+        help='Store cache in this SQLite file, instead of one file per anime')
+    arg_parser.add_argument('--engine', choices=['async', 'thread'], default='async',
+        help='Fetch engine, asyncio or one thread per site')
     arg_parser.add_argument('--checkpoint', default='',
-        help='File path to checkpoint (all.tmp.json).')
+        help='File path to checkpoint (all.tmp.jsonl).')
+    arg_parser.add_argument('--parse_workers', type=int, default=os.cpu_count(),
+        help='Number of worker processes parsing responses, 0 to parse in the fetching threads')
     args = arg_parser.parse_args()
 
     def save_json(data):